@@ -0,0 +1,310 @@
+from epatools import Profiling
+from instrumentation import rss_bytes
+from polars.testing import assert_frame_equal
+from survey import SocioEconomicStatus
+
+import argparse
+import datetime
+import json
+import numpy as np
+import os
+import platform
+import polars as pl
+import re
+import threading
+import time
+
+
+# answers of survey questions, by question concept id
+SURVEY_QUESTIONS = {1585375: ("Income: Annual Income",
+                              ["Annual Income: less 10k", "Annual Income: 10k 25k", "Annual Income: 25k 35k",
+                               "Annual Income: 35k 50k", "Annual Income: 50k 75k", "Annual Income: 75k 100k",
+                               "Annual Income: 100k 150k", "Annual Income: 150k 200k", "Annual Income: more 200k"]),
+                    1585940: ("Education: Highest Grade",
+                              ["Highest Grade: Never Attended", "Highest Grade: One Through Four",
+                               "Highest Grade: Five Through Eight", "Highest Grade: Nine Through Eleven",
+                               "Highest Grade: Twelve Or GED", "Highest Grade: College One to Three",
+                               "Highest Grade: College Graduate", "Highest Grade: Advanced Degree"]),
+                    1585370: ("Home Own: Current Home Own",
+                              ["Current Home Own: Own", "Current Home Own: Rent",
+                               "Current Home Own: Other Arrangement"]),
+                    1585952: ("Employment: Employment Status",
+                              ["Employment Status: Employed For Wages", "Employment Status: Homemaker",
+                               "Employment Status: Out Of Work Less Than One",
+                               "Employment Status: Out Of Work One Or More", "Employment Status: Retired",
+                               "Employment Status: Self Employed", "Employment Status: Student",
+                               "Employment Status: Unable To Work"]),
+                    1585860: ("Smoking: Smoke Frequency",
+                              ["Smoke Frequency: Every Day", "Smoke Frequency: Some Days",
+                               "Smoke Frequency: Not At All"])}
+
+
+def synthetic_epa_data(n_zip3=50, years=5, monitors_per_day=2, param_name="ozone",
+                       start_date=datetime.date(2010, 1, 1), missing_day_rate=0.2, null_aqi_day_rate=0.0, seed=0):
+    """
+    :param n_zip3: number of zip3s with measurement, named "100", "101", ...
+    :param years: number of years of daily measurement
+    :param monitors_per_day: number of monitor rows per zip3 and day
+    :param param_name: defaults to "ozone"; if "aqi", data has no arithmetic_mean column
+    :param start_date: first measured date
+    :param missing_day_rate: share of monitor rows dropped at random
+    :param null_aqi_day_rate: share of zip3-days whose monitor rows all have null AQI, e.g., non-primary monitors
+    :param seed: random seed
+    :return: polars df shaped like EPA data, with date, zip3, aqi and arithmetic_mean columns
+    """
+    rng = np.random.default_rng(seed)
+    n_days = 365 * years
+    n_rows = n_zip3 * n_days * monitors_per_day
+
+    days = np.tile(np.repeat(np.arange(n_days), monitors_per_day), n_zip3)
+    days += (start_date - datetime.date(1970, 1, 1)).days
+    zip3 = np.repeat(np.arange(100, 100 + n_zip3), n_days * monitors_per_day).astype(str)
+    arithmetic_mean = rng.gamma(shape=4.0, scale=8.0, size=n_rows)
+    aqi = np.clip(np.round(arithmetic_mean * 1.6 + rng.normal(0, 5, n_rows)), 0, 500)
+    keep = rng.random(n_rows) >= missing_day_rate
+    null_aqi_days = np.repeat(rng.random(n_zip3 * n_days) < null_aqi_day_rate, monitors_per_day)
+
+    epa_data = pl.DataFrame({"date": pl.Series(days[keep], dtype=pl.Int32).cast(pl.Date),
+                             "zip3": zip3[keep],
+                             "aqi": pl.Series(aqi[keep]).set(pl.Series(null_aqi_days[keep]), None)})
+    if param_name != "aqi":
+        epa_data = epa_data.with_columns(pl.Series("arithmetic_mean", arithmetic_mean[keep]))
+
+    return epa_data
+
+
+def synthetic_participant_dx_period(n_participants, n_zip3=50, unmeasured_zip3_rate=0.1, years=5,
+                                    start_date=datetime.date(2010, 1, 1), seed=1):
+    """
+    :param n_participants: number of participants, one diagnosis period each
+    :param n_zip3: number of zip3s with measurement, as in synthetic_epa_data
+    :param unmeasured_zip3_rate: share of participants living in zip3s without measurement
+    :param years: number of years diagnosis periods start in
+    :param start_date: first possible diagnosis start date
+    :param seed: random seed
+    :return: polars df with person_id, zip3, start_date and end_date columns
+    """
+    rng = np.random.default_rng(seed)
+
+    zip3 = rng.integers(100, 100 + n_zip3, n_participants)
+    unmeasured = rng.random(n_participants) < unmeasured_zip3_rate
+    zip3 = np.where(unmeasured, rng.integers(900, 1000, n_participants), zip3).astype(str)
+    start_days = rng.integers(0, 365 * years, n_participants) + (start_date - datetime.date(1970, 1, 1)).days
+    end_days = start_days + rng.exponential(180, n_participants).astype(np.int64)
+
+    return pl.DataFrame({"person_id": np.arange(n_participants).astype(str),
+                         "zip3": zip3,
+                         "start_date": pl.Series(start_days, dtype=pl.Int32).cast(pl.Date),
+                         "end_date": pl.Series(end_days, dtype=pl.Int32).cast(pl.Date)})
+
+
+def synthetic_survey_data(n_participants, no_answer_rate=0.03, seed=2):
+    """
+    :param n_participants: number of participants, each answering every question in SURVEY_QUESTIONS
+    :param no_answer_rate: share of answers replaced by a PMI skip answer
+    :param seed: random seed
+    :return: polars df shaped like ds_survey
+    """
+    rng = np.random.default_rng(seed)
+
+    question_dfs = []
+    for question_concept_id, (question, answers) in SURVEY_QUESTIONS.items():
+        answer = np.array(answers)[rng.integers(0, len(answers), n_participants)]
+        answer = np.where(rng.random(n_participants) < no_answer_rate, "PMI: Skip", answer)
+        question_dfs.append(pl.DataFrame({"person_id": np.arange(n_participants, dtype=np.int64),
+                                          "question_concept_id": np.full(n_participants, question_concept_id),
+                                          "question": np.full(n_participants, question),
+                                          "answer": answer}))
+
+    return pl.concat(question_dfs)
+
+
+def synthetic_zip_code_ses(n_participants, seed=3):
+    """
+    :param n_participants: number of participants
+    :param seed: random seed
+    :return: polars df shaped like ds_zip_code_socioeconomic
+    """
+    rng = np.random.default_rng(seed)
+
+    return pl.DataFrame({"PERSON_ID": np.arange(n_participants, dtype=np.int64),
+                         "ZIP3_AS_STRING": rng.integers(100, 1000, n_participants).astype(str),
+                         "MEDIAN_INCOME": np.round(rng.lognormal(11, 0.5, n_participants), 2)})
+
+
+class FakeBigQueryClient:
+    """
+    stands in for bigquery.Client; answers queries with in-memory tables, by table name found in query
+    """
+
+    def __init__(self, tables, batch_size=10000):
+        """
+        :param tables: dict of table name, e.g., "ds_survey", to polars df
+        :param batch_size: defaults to 10000; rows per Arrow record batch of streamed results
+        """
+        self.tables = tables
+        self.batch_size = batch_size
+        self.queries = []
+
+    def query(self, query):
+        self.queries.append(query)
+        for table_name, table in self.tables.items():
+            if f".{table_name}" in query:
+                # apply question filter of survey queries, as BigQuery would
+                question_ids = re.search(r"question_concept_id IN \(([\d,\s]+)\)", query)
+                if question_ids is not None and "question_concept_id" in table.columns:
+                    question_ids = [int(question_id) for question_id in question_ids.group(1).split(",")
+                                    if question_id.strip()]
+                    table = table.filter(pl.col("question_concept_id").is_in(question_ids))
+                return _FakeQueryJob(table, self.batch_size)
+        raise ValueError(f"No fake table for query: {query}")
+
+
+class _FakeQueryJob:
+
+    def __init__(self, table, batch_size):
+        self.table = table
+        self.batch_size = batch_size
+
+    def result(self):
+        return self
+
+    def to_arrow(self):
+        return self.table.to_arrow()
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        for offset in range(0, len(self.table), self.batch_size):
+            yield from self.table.slice(offset, self.batch_size).to_arrow().to_batches()
+
+
+def measure(func, *args, interval=0.01, **kwargs):
+    """
+    run func once, sampling memory in a background thread
+    :param func: function to measure
+    :param interval: seconds between memory samples
+    :return: func result and dict of seconds, peak_rss_bytes and peak_rss_increase_bytes
+    """
+    baseline = rss_bytes()
+    peak = [baseline]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], rss_bytes())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - start
+        done.set()
+        sampler.join()
+    peak[0] = max(peak[0], rss_bytes())
+
+    return result, {"seconds": seconds,
+                    "peak_rss_bytes": peak[0],
+                    "peak_rss_increase_bytes": peak[0] - baseline}
+
+
+def frames_match(reference, other):
+    """
+    :return: True if frames have same schema and values, up to float rounding
+    """
+    try:
+        assert_frame_equal(reference, other, rtol=1e-6)
+    except AssertionError:
+        return False
+    return True
+
+
+def run_benchmarks(sizes=(1000, 10000, 100000, 1000000), engines=("rows", "columnar", "index"),
+                   max_rows_engine_size=10000, n_zip3=50, years=5, monitors_per_day=2, param_name="ozone",
+                   output_path="benchmark_results.json"):
+    """
+    time and record peak memory of profiling and survey parsing hot paths across participant counts
+    :param sizes: numbers of participants to benchmark
+    :param engines: create_epa_param_profile engines to benchmark
+    :param max_rows_engine_size: "rows" engine is skipped above this many participants
+    :param n_zip3: number of zip3s in synthetic EPA data
+    :param years: years of synthetic EPA data
+    :param monitors_per_day: monitor rows per zip3 and day in synthetic EPA data
+    :param param_name: environmental parameter of synthetic EPA data
+    :param output_path: path of JSON result file; None to skip writing
+    :return: dict of benchmark metadata and results
+    """
+    epa_data = synthetic_epa_data(n_zip3=n_zip3, years=years, monitors_per_day=monitors_per_day,
+                                  param_name=param_name)
+    report = {"created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(),
+              "polars": pl.__version__,
+              "cpu_count": os.cpu_count(),
+              "epa_rows": len(epa_data),
+              "results": []}
+
+    def record(benchmark, n_participants, stats, **extra):
+        result = {"benchmark": benchmark, "n_participants": n_participants, **stats, **extra}
+        report["results"].append(result)
+        print(json.dumps(result))
+
+    profiling = Profiling()
+    for n_participants in sizes:
+        participant_dx_period = synthetic_participant_dx_period(n_participants, n_zip3=n_zip3, years=years)
+
+        # get_aqi, one participant row
+        row = participant_dx_period.row(0, named=True)
+        _, stats = measure(profiling.get_aqi, epa_data, param_name, "date",
+                           row["start_date"], row["end_date"], row["zip3"], row["person_id"])
+        record("get_aqi", n_participants, stats)
+
+        # create_epa_param_profile, by engine; first engine run is the reference output
+        reference = None
+        reference_engine = None
+        for engine in engines:
+            if engine == "rows" and n_participants > max_rows_engine_size:
+                continue
+            profile, stats = measure(profiling.create_epa_param_profile, participant_dx_period, epa_data,
+                                     param_name, engine=engine)
+            if reference is None:
+                reference = profile
+                reference_engine = engine
+            record("create_epa_param_profile", n_participants, stats, engine=engine, rows=len(profile),
+                   reference_engine=reference_engine, matches_reference=frames_match(reference, profile))
+
+        # survey parsing, against a fake BigQuery client
+        client = FakeBigQueryClient({"ds_survey": synthetic_survey_data(n_participants),
+                                     "ds_zip_code_socioeconomic": synthetic_zip_code_ses(n_participants)})
+        ses = SocioEconomicStatus("synthetic", client=client)
+        survey_data, stats = measure(ses.parse_survey_data)
+        record("parse_survey_data", n_participants, stats, rows=len(survey_data))
+        streamed_survey_data, stats = measure(ses.parse_survey_data, streaming=True)
+        record("parse_survey_data", n_participants, stats, streaming=True, rows=len(streamed_survey_data),
+               matches_reference=frames_match(survey_data, streamed_survey_data))
+
+        income_data = survey_data.select(["person_id", "income_bracket"])
+        compared, stats = measure(ses.compare_with_median_income, income_data)
+        record("compare_with_median_income", n_participants, stats, rows=len(compared))
+
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark EPA profiling and survey parsing on synthetic data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000],
+                        help="numbers of participants")
+    parser.add_argument("--engines", nargs="+", default=["rows", "columnar", "index"],
+                        help="create_epa_param_profile engines")
+    parser.add_argument("--max-rows-engine-size", type=int, default=10000,
+                        help="skip rows engine above this many participants")
+    parser.add_argument("--n-zip3", type=int, default=50, help="zip3s in synthetic EPA data")
+    parser.add_argument("--years", type=int, default=5, help="years of synthetic EPA data")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON result file")
+    args = parser.parse_args()
+
+    run_benchmarks(sizes=args.sizes, engines=args.engines, max_rows_engine_size=args.max_rows_engine_size,
+                   n_zip3=args.n_zip3, years=args.years, output_path=args.output)
@@ -1,23 +1,59 @@
-from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from instrumentation import NO_INSTRUMENTATION
 from tqdm import tqdm
 
 import datetime
+import multiprocessing
 import numpy as np
 import os
 import polars as pl
+import tempfile
+import threading
+import weakref
+
+# days of measurement looked back from diagnosis start date
+DX_LOOKBACK_DAYS = 1000
+
+# day 0 of polars Date
+EPOCH = datetime.date(1970, 1, 1)
 
 
 class Profiling:
 
-    def __init__(self):
-        pass
+    # all time means of (EPA df, param, zip3), shared across get_aqi calls; least recently used evicted first
+    all_time_means_cache = OrderedDict()
+    all_time_means_cache_size = 4096
+    all_time_means_cache_lock = threading.Lock()
+
+    def __init__(self, instrumentation=None):
+        """
+        :param instrumentation: defaults to None, i.e., no instrumentation; Instrumentation to record stage timings in
+        """
+        self.instrumentation = instrumentation
+        if self.instrumentation is None:
+            self.instrumentation = NO_INSTRUMENTATION
 
-    def create_epa_param_profile(self, participant_dx_period, epa_data, param_name, profile_type="aqi"):
+    def create_epa_param_profile(self, participant_dx_period, epa_data, param_name, profile_type="aqi",
+                                 engine="rows", backend="threads", n_workers=None, chunk_size=100000, dedupe=True):
         """
         :param participant_dx_period: participant df containing diagnosis period
-        :param epa_data: EPA df of interest
+        :param epa_data: EPA df of interest, a lazy frame or Parquet/IPC file path of it, or a prebuilt AQIIndex of it
         :param param_name: environmental parameter of interest
         :param profile_type: accepts "aqi"
+        :param engine: defaults to "rows"; "rows" profiles one participant row at a time with get_aqi,
+                       "columnar" profiles all participant rows at once with get_aqi_columnar,
+                       "index" profiles all participant rows at once with AQIIndex.query_many
+        :param backend: defaults to "threads"; "threads" runs "rows" engine jobs in a thread pool,
+                        "serial" runs them one after another,
+                        "processes" partitions participants by zip3 and profiles each partition in a worker process
+                        with only its zip3 slice of EPA data, shared as Arrow IPC file,
+                        "chunked" partitions participants by zip3 into chunks of about chunk_size rows
+                        and profiles them one after another
+        :param n_workers: defaults to None, i.e., number of CPUs minus 1; number of threads or processes
+        :param chunk_size: defaults to 100000; participant rows per chunk for "chunked" backend
+        :param dedupe: defaults to True; if True, participant rows with identical zip3, start_date and end_date
+                       are profiled once and results are fanned out to all of them
         :return: original df with param aqi ratio added
         """
 
@@ -26,46 +62,316 @@ class Profiling:
             print(f"Input dataframe must have these columns: {required_cols}")
             return
 
-        if profile_type == "aqi":
-            profile_function = self.get_aqi
-
-        jobs = []
-        with ThreadPoolExecutor(max_workers=os.cpu_count() - 1) as executor:
-            for i in tqdm(range(len(participant_dx_period))):
-                jobs.append(executor.submit(profile_function,
-                                            epa_data,
-                                            param_name,
-                                            "date",
-                                            participant_dx_period[i, "start_date"],
-                                            participant_dx_period[i, "end_date"],
-                                            participant_dx_period[i, "zip3"],
-                                            participant_dx_period[i, "person_id"]))
-        result_dicts = [job.result() for job in jobs]
-
-        param_ratio_df = pl.from_dicts(result_dicts, schema={f"{param_name}_all_time_mean_raw_value": pl.Float64,
-                                                             f"{param_name}_all_time_mean_aqi": pl.Float64,
-                                                             f"{param_name}_mean_raw_value": pl.Float64,
-                                                             f"{param_name}_mean_aqi": pl.Float64,
-                                                             f"{param_name}_aqi_0to25_days": pl.Float64,
-                                                             f"{param_name}_aqi_26to50_days": pl.Float64,
-                                                             f"{param_name}_aqi_51to75_days": pl.Float64,
-                                                             f"{param_name}_aqi_76to100_days": pl.Float64,
-                                                             f"{param_name}_aqi_101to150_days": pl.Float64,
-                                                             f"{param_name}_aqi_151plus_days": pl.Float64,
-                                                             f"{param_name}_first_measured_date": pl.Date,
-                                                             f"{param_name}_measured_days_before_dx": pl.Float64,
-                                                             f"{param_name}_total_measured_days": pl.Float64,
-                                                             f"{param_name}_total_dx_days": pl.Float64,
-                                                             f"{param_name}_data_coverage": pl.Float64,
-                                                             "person_id": pl.Utf8})
-
-        final_df = participant_dx_period.join(param_ratio_df, how="inner", on="person_id")
+        param_ratio_df = self.profile_param(participant_dx_period, epa_data, param_name, profile_type, engine,
+                                            backend=backend, n_workers=n_workers, chunk_size=chunk_size,
+                                            dedupe=dedupe)
+
+        with self.instrumentation.stage("final join") as stage:
+            final_df = participant_dx_period.join(param_ratio_df, how="inner", on="person_id")
+            stage["rows"] = len(final_df)
 
         return final_df
 
+    def create_epa_profile(self, participant_dx_period, epa_data_dict, profile_type="aqi", engine="index",
+                           backend="threads", n_workers=None, chunk_size=100000, dedupe=True):
+        """
+        profile several environmental parameters in one call; participant windows are prepared once
+        and shared across parameters
+        :param participant_dx_period: participant df containing diagnosis period
+        :param epa_data_dict: dict of param name to EPA df of interest, a lazy frame or Parquet/IPC file path of it,
+                              or a prebuilt AQIIndex of it
+        :param profile_type: accepts "aqi"
+        :param engine: defaults to "index"; see create_epa_param_profile
+        :param backend: defaults to "threads"; see create_epa_param_profile
+        :param n_workers: defaults to None; see create_epa_param_profile
+        :param chunk_size: defaults to 100000; see create_epa_param_profile
+        :param dedupe: defaults to True; see create_epa_param_profile
+        :return: original df with aqi ratio of each param added, rows in the same order as input
+        """
+
+        required_cols = ["person_id", "zip3", "start_date", "end_date"]
+        if not set(required_cols).issubset(participant_dx_period.columns):
+            print(f"Input dataframe must have these columns: {required_cols}")
+            return
+
+        unique_windows, window_ids = participant_dx_period, None
+        with self.instrumentation.stage("window preparation", rows=len(participant_dx_period)):
+            if dedupe:
+                unique_windows, window_ids = self.dedupe_windows(participant_dx_period)
+            windows = self.prepare_windows(unique_windows)
+
+        # each param result is aligned with participant rows, so columns are stacked instead of joined
+        profile_cols = []
+        for param_name, epa_data in epa_data_dict.items():
+            param_ratio_df = self.profile_param(unique_windows, epa_data, param_name, profile_type, engine,
+                                                windows=windows, backend=backend, n_workers=n_workers,
+                                                chunk_size=chunk_size, dedupe=False)
+            profile_cols.extend(param_ratio_df.drop("person_id").get_columns())
+        with self.instrumentation.stage("result assembly", rows=len(participant_dx_period)):
+            if window_ids is not None:
+                profile_cols = [col[window_ids] for col in profile_cols]
+            final_df = participant_dx_period.hstack(profile_cols)
+
+        return final_df
+
+    def profile_param(self, participant_dx_period, epa_data, param_name, profile_type="aqi", engine="rows",
+                      windows=None, backend="threads", n_workers=None, chunk_size=100000, dedupe=False):
+        """
+        :param participant_dx_period: participant df containing diagnosis period
+        :param epa_data: EPA df of interest, a lazy frame or Parquet/IPC file path of it, or a prebuilt AQIIndex of it
+        :param param_name: environmental parameter of interest
+        :param profile_type: accepts "aqi"
+        :param engine: defaults to "rows"; see create_epa_param_profile
+        :param windows: defaults to None; output of prepare_windows, reused by the "index" engine
+        :param backend: defaults to "threads"; see create_epa_param_profile
+        :param n_workers: defaults to None; see create_epa_param_profile
+        :param chunk_size: defaults to 100000; see create_epa_param_profile
+        :param dedupe: defaults to False; see create_epa_param_profile
+        :return: df of param aqi ratio, one row per participant row, keyed on person_id
+        """
+
+        if n_workers is None:
+            n_workers = max(1, os.cpu_count() - 1)
+
+        # lazy inputs are only scanned for what participants need, using streaming engine
+        if not isinstance(epa_data, (pl.DataFrame, AQIIndex)):
+            epa_data = self.scan_epa_data(epa_data)
+
+        if dedupe:
+            with self.instrumentation.stage("window preparation", rows=len(participant_dx_period)):
+                unique_windows, window_ids = self.dedupe_windows(participant_dx_period)
+            if window_ids is not None:
+                param_ratio_df = self.profile_param(unique_windows, epa_data, param_name, profile_type, engine,
+                                                    backend=backend, n_workers=n_workers, chunk_size=chunk_size)
+                return param_ratio_df[window_ids].with_columns(participant_dx_period["person_id"].cast(pl.Utf8))
+
+        if backend in ("processes", "chunked") and not isinstance(epa_data, AQIIndex):
+            return self.profile_param_partitions(participant_dx_period, epa_data, param_name, profile_type, engine,
+                                                 backend, n_workers, chunk_size)
+
+        if engine == "index" or isinstance(epa_data, AQIIndex):
+            if profile_type == "aqi":
+                if not isinstance(epa_data, AQIIndex):
+                    with self.instrumentation.stage("index build"):
+                        epa_data = AQIIndex(epa_data, param_name, "date",
+                                            participant_dx_period=participant_dx_period)
+                with self.instrumentation.stage("index query", rows=len(participant_dx_period)):
+                    param_ratio_df = epa_data.query_many(participant_dx_period, windows=windows)
+        elif engine == "columnar":
+            if profile_type == "aqi":
+                with self.instrumentation.stage("columnar query", rows=len(participant_dx_period)):
+                    param_ratio_df = self.get_aqi_columnar(participant_dx_period, epa_data, param_name, "date")
+        else:
+            if profile_type == "aqi":
+                profile_function = self.get_aqi_values
+
+            # all time means need all dates of participant zip3s
+            if isinstance(epa_data, pl.LazyFrame):
+                with self.instrumentation.stage("epa scan") as stage:
+                    epa_data = (epa_data.filter(pl.col("zip3").is_in(participant_dx_period["zip3"].unique()))
+                                .collect(streaming=True))
+                    stage["rows"] = len(epa_data)
+
+            # each job writes its results into its own row of preallocated buffers
+            values, first_measured_days = self.aqi_buffers(param_name, len(participant_dx_period))
+            start_dates = participant_dx_period["start_date"].to_list()
+            end_dates = participant_dx_period["end_date"].to_list()
+            zip3s = participant_dx_period["zip3"].to_list()
+
+            def profile_row(i):
+                self.fill_aqi_buffers(values, first_measured_days, i,
+                                      profile_function(epa_data, param_name, "date",
+                                                       start_dates[i], end_dates[i], zip3s[i],
+                                                       instrumentation=self.instrumentation))
+
+            if backend == "serial":
+                for i in range(len(participant_dx_period)):
+                    profile_row(i)
+            else:
+                with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                    jobs = [executor.submit(profile_row, i) for i in range(len(participant_dx_period))]
+                    # progress tracks completed jobs
+                    for job in tqdm(as_completed(jobs), total=len(jobs)):
+                        job.result()
+
+            with self.instrumentation.stage("result assembly", rows=len(participant_dx_period)):
+                param_ratio_df = self.aqi_buffers_to_frame(param_name, values, first_measured_days,
+                                                           participant_dx_period["person_id"])
+
+        return param_ratio_df
+
+    def profile_param_partitions(self, participant_dx_period, epa_data, param_name, profile_type="aqi",
+                                 engine="rows", backend="processes", n_workers=None, chunk_size=100000):
+        """
+        profile participants partition by partition, each partition with only its zip3 slice of EPA data
+        :param participant_dx_period: participant df containing diagnosis period
+        :param epa_data: EPA df of interest
+        :param param_name: environmental parameter of interest
+        :param profile_type: accepts "aqi"
+        :param engine: defaults to "rows"; see create_epa_param_profile
+        :param backend: defaults to "processes"; accepts "processes" or "chunked", see create_epa_param_profile
+        :param n_workers: defaults to None; see create_epa_param_profile
+        :param chunk_size: defaults to 100000; see create_epa_param_profile
+        :return: df of param aqi ratio, one row per participant row, keyed on person_id
+        """
+
+        if len(participant_dx_period) == 0:
+            return pl.DataFrame(schema=self.aqi_schema(param_name))
+
+        if n_workers is None:
+            n_workers = max(1, os.cpu_count() - 1)
+
+        if backend == "processes":
+            n_partitions = n_workers
+        else:
+            n_partitions = -(-len(participant_dx_period) // chunk_size)
+        with self.instrumentation.stage("partitioning", rows=len(participant_dx_period)):
+            partitions = self.partition_by_zip3(participant_dx_period, n_partitions)
+
+        epa_data = epa_data.lazy()
+        results = []
+        if backend == "processes":
+            # spawned workers memory-map their EPA slice from Arrow IPC files instead of receiving pickled copies
+            with tempfile.TemporaryDirectory() as tmp_dir, \
+                    ProcessPoolExecutor(max_workers=n_workers,
+                                        mp_context=multiprocessing.get_context("spawn")) as executor:
+                jobs = []
+                for k, rows in enumerate(partitions):
+                    participant_part = participant_dx_period[rows]
+                    epa_path = os.path.join(tmp_dir, f"epa_{k}.arrow")
+                    with self.instrumentation.stage("epa partition filter") as stage:
+                        epa_part = (epa_data.filter(pl.col("zip3").is_in(participant_part["zip3"].unique()))
+                                    .collect(streaming=True))
+                        epa_part.write_ipc(epa_path)
+                        stage["rows"] = len(epa_part)
+                    del epa_part
+                    jobs.append(executor.submit(_profile_partition, participant_part, epa_path,
+                                                param_name, profile_type, engine))
+                # progress tracks completed partitions; stages inside worker processes are not recorded
+                with self.instrumentation.stage("worker profiling", rows=len(participant_dx_period)):
+                    for _ in tqdm(as_completed(jobs), total=len(jobs)):
+                        pass
+                results = [job.result() for job in jobs]
+        else:
+            for rows in tqdm(partitions):
+                participant_part = participant_dx_period[rows]
+                with self.instrumentation.stage("epa partition filter") as stage:
+                    epa_part = (epa_data.filter(pl.col("zip3").is_in(participant_part["zip3"].unique()))
+                                .collect(streaming=True))
+                    stage["rows"] = len(epa_part)
+                results.append(self.profile_param(participant_part, epa_part, param_name, profile_type, engine,
+                                                  backend="serial"))
+
+        # restore participant row order
+        with self.instrumentation.stage("result assembly", rows=len(participant_dx_period)):
+            row_order = np.argsort(np.concatenate(partitions), kind="stable")
+            param_ratio_df = pl.concat(results)[row_order]
+
+        return param_ratio_df
+
+    @staticmethod
+    def scan_epa_data(epa_data):
+        """
+        :param epa_data: EPA df, lazy frame, or Parquet/IPC file path
+        :return: polars lazy frame of EPA data
+        """
+        if isinstance(epa_data, (str, os.PathLike)):
+            if str(epa_data).endswith((".arrow", ".ipc", ".feather")):
+                return pl.scan_ipc(epa_data)
+            return pl.scan_parquet(epa_data)
+
+        return epa_data.lazy()
+
+    @staticmethod
+    def partition_by_zip3(participant_dx_period, n_partitions):
+        """
+        split participant rows into partitions of whole zip3s with balanced row counts
+        :param participant_dx_period: participant df containing zip3
+        :param n_partitions: max number of partitions
+        :return: list of numpy arrays of row indices; empty partitions are dropped
+        """
+        zip3_rows = (participant_dx_period.select("zip3")
+                     .with_columns(pl.Series("row_nr", np.arange(len(participant_dx_period), dtype=np.int64)))
+                     .group_by("zip3")
+                     .agg(pl.col("row_nr"))
+                     .with_columns(pl.col("row_nr").list.len().alias("n_rows"))
+                     .sort("n_rows", descending=True))
+
+        # largest zip3s first, each to the partition with fewest rows so far
+        partition_rows = [[] for _ in range(max(1, n_partitions))]
+        partition_sizes = np.zeros(len(partition_rows), dtype=np.int64)
+        for rows in zip3_rows["row_nr"]:
+            k = int(np.argmin(partition_sizes))
+            partition_rows[k].append(rows.to_numpy())
+            partition_sizes[k] += len(rows)
+
+        return [np.concatenate(rows) for rows in partition_rows if len(rows) > 0]
+
+    @staticmethod
+    def dedupe_windows(participant_dx_period):
+        """
+        :param participant_dx_period: participant df containing zip3, start_date and end_date
+        :return: df of unique (zip3, start_date, end_date) windows, with window position as person_id,
+                 and numpy array of window position of each participant row;
+                 participant_dx_period and None if all windows are unique
+        """
+        window_cols = ["zip3", "start_date", "end_date"]
+        unique_windows = participant_dx_period.select(window_cols).unique(maintain_order=True)
+        if len(unique_windows) == len(participant_dx_period):
+            return participant_dx_period, None
+
+        unique_windows = unique_windows.with_columns(pl.Series("window_id", np.arange(len(unique_windows))))
+        window_ids = (participant_dx_period.select(window_cols)
+                      .join(unique_windows, how="left", on=window_cols, join_nulls=True)["window_id"]
+                      .to_numpy())
+        unique_windows = unique_windows.select(pl.col("window_id").cast(pl.Utf8).alias("person_id"), *window_cols)
+
+        return unique_windows, window_ids
+
+    @staticmethod
+    def prepare_windows(participant_dx_period):
+        """
+        :param participant_dx_period: participant df containing person_id, zip3, start_date and end_date
+        :return: dict of participant person_id, unique zip3s, position of each row's zip3 in unique zip3s
+                 (-1 for null zip3), and start and end dates as days since epoch
+        """
+        unique_zip3 = participant_dx_period.select(pl.col("zip3").unique())
+        unique_zip3 = unique_zip3.with_columns(pl.Series("zip3_position",
+                                                         np.arange(len(unique_zip3), dtype=np.int64)))
+        zip3_position = participant_dx_period.select("zip3").join(unique_zip3, how="left", on="zip3")
+
+        return {"person_id": participant_dx_period["person_id"].cast(pl.Utf8),
+                "unique_zip3": unique_zip3["zip3"],
+                "zip3_position": zip3_position["zip3_position"].fill_null(-1).to_numpy(),
+                "start_days": participant_dx_period["start_date"].cast(pl.Date).to_physical().to_numpy(),
+                "end_days": participant_dx_period["end_date"].cast(pl.Date).to_physical().to_numpy()}
+
+    @staticmethod
+    def aqi_schema(param_name):
+        """
+        :param param_name: name of param
+        :return: schema of AQI profile columns, keyed on person_id
+        """
+        return {f"{param_name}_all_time_mean_raw_value": pl.Float64,
+                f"{param_name}_all_time_mean_aqi": pl.Float64,
+                f"{param_name}_mean_raw_value": pl.Float64,
+                f"{param_name}_mean_aqi": pl.Float64,
+                f"{param_name}_aqi_0to25_days": pl.Float64,
+                f"{param_name}_aqi_26to50_days": pl.Float64,
+                f"{param_name}_aqi_51to75_days": pl.Float64,
+                f"{param_name}_aqi_76to100_days": pl.Float64,
+                f"{param_name}_aqi_101to150_days": pl.Float64,
+                f"{param_name}_aqi_151plus_days": pl.Float64,
+                f"{param_name}_first_measured_date": pl.Date,
+                f"{param_name}_measured_days_before_dx": pl.Float64,
+                f"{param_name}_total_measured_days": pl.Float64,
+                f"{param_name}_total_dx_days": pl.Float64,
+                f"{param_name}_data_coverage": pl.Float64,
+                "person_id": pl.Utf8}
+
     @staticmethod
     def get_aqi(param_df, param_name, date_col,
-                start_date, end_date, zip3, person_id=None):
+                start_date, end_date, zip3, person_id=None, instrumentation=None):
         """
         :param param_df: polars df contains data for param of interest
         :param param_name: name of param
@@ -74,94 +380,802 @@ class Profiling:
         :param end_date: end date of param data
         :param zip3: zip3 of site measured param
         :param person_id: defaults to None; person id of interest
+        :param instrumentation: defaults to None, i.e., no instrumentation; Instrumentation to record stage timings in
         :return: new columns with AQI related data
         """
+        aqi_cols = [col for col in Profiling.aqi_schema(param_name) if col != "person_id"]
+        first_measured_date_col = f"{param_name}_first_measured_date"
+
+        aqi_values = Profiling.get_aqi_values(param_df, param_name, date_col, start_date, end_date, zip3,
+                                              instrumentation=instrumentation)
+        if aqi_values is None:
+            aqi_dict = {col: np.nan for col in aqi_cols}
+            aqi_dict[first_measured_date_col] = datetime.date(1900, 1, 1)
+        else:
+            values, first_measured_date = aqi_values
+            value_cols = [col for col in aqi_cols if col != first_measured_date_col]
+            aqi_dict = dict(zip(value_cols, values))
+            aqi_dict[first_measured_date_col] = first_measured_date
+            # keep column order of aqi_schema
+            aqi_dict = {col: aqi_dict[col] for col in aqi_cols}
+
+        if person_id:
+            aqi_dict["person_id"] = person_id
+
+        return aqi_dict
+
+    @staticmethod
+    def get_aqi_values(param_df, param_name, date_col, start_date, end_date, zip3, instrumentation=None):
+        """
+        AQI related data of get_aqi as plain values, to be written into column buffers
+        :param param_df: polars df contains data for param of interest
+        :param param_name: name of param
+        :param date_col: column name of date
+        :param start_date: start date of param data
+        :param end_date: end date of param data
+        :param zip3: zip3 of site measured param
+        :param instrumentation: defaults to None, i.e., no instrumentation; Instrumentation to record stage timings in
+        :return: tuple of float columns of aqi_schema in order, and first measured date;
+                 None if zip3 has no measurement in date window
+        """
+        # zip3-days whose readings of a value are all null have no daily mean of it; they count as measured days,
+        # but are left out of means, and of AQI bins if AQI is missing
+        value_cols = ["aqi"]
+        if param_name != "aqi":
+            value_cols.append("arithmetic_mean")
+
+        if instrumentation is None:
+            instrumentation = NO_INSTRUMENTATION
+        timer = instrumentation.timer()
 
         param_by_zip3 = param_df.filter(pl.col("zip3") == zip3)
+        timer.lap("epa zip3 filter", rows=len(param_df))
+
+        if len(param_by_zip3) == 0:
+            return None
+
+        # all time mean values
+        all_time_mean_raw_value, all_time_mean_aqi = Profiling.get_all_time_means(param_df, param_by_zip3,
+                                                                                  param_name, zip3)
+        timer.lap("all time means", rows=len(param_by_zip3))
+
+        # move start_date back 365 days
+        # this to ensure measurement starts 1 year ahead
+        # in case dx period is short, e.g., few days, there should still be enough measurement data
+        dx_start_date = start_date
+        start_date = start_date - datetime.timedelta(DX_LOOKBACK_DAYS)
+
+        # filter data
+        param_by_zip3_and_date = param_by_zip3.filter((pl.col(date_col) >= start_date) &
+                                                      (pl.col(date_col) <= end_date))
+        timer.lap("epa date filter", rows=len(param_by_zip3))
+
+        if len(param_by_zip3_and_date) == 0:
+            return None
+
+        # get first measured_date before grouping
+        first_measured_date = param_by_zip3_and_date[date_col].min()
+
+        # group by zip3 & date and get mean value
+        n_measurements = len(param_by_zip3_and_date)
+        param_by_zip3_and_date = param_by_zip3_and_date.groupby([date_col, "zip3"]).mean()
+        # group_by means of all-null groups may come out as NaN instead of null, depending on frame size
+        param_by_zip3_and_date = param_by_zip3_and_date.with_columns(pl.col(value_cols).fill_nan(None))
+        timer.lap("daily group_by", rows=n_measurements)
+
+        # days by thresholds
+        sub25days = len(param_by_zip3_and_date.filter(pl.col("aqi") <= 25))
+        sub50days = len(param_by_zip3_and_date.filter(pl.col("aqi") <= 50))
+        sub75days = len(param_by_zip3_and_date.filter(pl.col("aqi") <= 75))
+        sub100days = len(param_by_zip3_and_date.filter(pl.col("aqi") <= 100))
+        sub150days = len(param_by_zip3_and_date.filter(pl.col("aqi") <= 150))
+
+        # days by bins
+        total_measured_days = len(param_by_zip3_and_date)
+        aqi26to50days = sub50days - sub25days
+        aqi51to75days = sub75days - sub50days
+        aqi76to100days = sub100days - sub75days
+        aqi101to150days = sub150days - sub100days
+        above150days = len(param_by_zip3_and_date.filter(pl.col("aqi") > 150))
+
+        # other stats
+        mean_raw_value = np.nan
+        if param_name != "aqi":
+            mean_raw_value = param_by_zip3_and_date.groupby("zip3").mean()["arithmetic_mean"][0]
+        mean_aqi = param_by_zip3_and_date.groupby("zip3").mean()["aqi"][0]
+        if mean_raw_value is None:
+            mean_raw_value = np.nan
+        if mean_aqi is None:
+            mean_aqi = np.nan
+        days_before_dx = len(param_by_zip3_and_date.filter(pl.col(date_col) <= dx_start_date))
+        dx_days = (end_date - dx_start_date).days + 1
+        data_coverage = total_measured_days / dx_days
+        timer.lap("binning", rows=total_measured_days)
+
+        # put all together, in aqi_schema order
+        values = (all_time_mean_raw_value,
+                  all_time_mean_aqi,
+                  mean_raw_value,
+                  mean_aqi,
+                  sub25days,
+                  aqi26to50days,
+                  aqi51to75days,
+                  aqi76to100days,
+                  aqi101to150days,
+                  above150days,
+                  days_before_dx,
+                  total_measured_days,
+                  dx_days,
+                  data_coverage)
+
+        return values, first_measured_date
+
+    @staticmethod
+    def aqi_buffers(param_name, n_rows):
+        """
+        preallocated column buffers of an AQI profile, filled in place one row at a time;
+        rows never filled keep the NaN and 1900-01-01 defaults of get_aqi
+        :param param_name: name of param
+        :param n_rows: number of profile rows
+        :return: column-major float array with one column per float column of aqi_schema,
+                 and int32 array of first measured date as days since epoch
+        """
+        n_value_cols = sum(dtype == pl.Float64 for dtype in Profiling.aqi_schema(param_name).values())
+        values = np.full((n_rows, n_value_cols), np.nan, order="F")
+        first_measured_days = np.full(n_rows, (datetime.date(1900, 1, 1) - EPOCH).days, dtype=np.int32)
+
+        return values, first_measured_days
+
+    @staticmethod
+    def fill_aqi_buffers(values, first_measured_days, row, aqi_values):
+        """
+        :param values: float buffer of aqi_buffers
+        :param first_measured_days: date buffer of aqi_buffers
+        :param row: row to fill
+        :param aqi_values: output of get_aqi_values; None leaves defaults in place
+        """
+        if aqi_values is not None:
+            values[row] = aqi_values[0]
+            first_measured_days[row] = aqi_values[1].toordinal() - EPOCH.toordinal()
+
+    @staticmethod
+    def aqi_buffers_to_frame(param_name, values, first_measured_days, person_id):
+        """
+        wrap filled buffers as polars df; column-major float columns are contiguous and not copied
+        :param param_name: name of param
+        :param values: float buffer of aqi_buffers
+        :param first_measured_days: date buffer of aqi_buffers
+        :param person_id: polars series of person_id of each row
+        :return: polars df with AQI related data, same schema as get_aqi results
+        """
+        schema = Profiling.aqi_schema(param_name)
+        value_cols = [col for col, dtype in schema.items() if dtype == pl.Float64]
+        columns = [pl.Series(col, values[:, i]) for i, col in enumerate(value_cols)]
+        columns.append(pl.Series(f"{param_name}_first_measured_date", first_measured_days).cast(pl.Date))
+        columns.append(person_id.cast(pl.Utf8).alias("person_id"))
+
+        return pl.DataFrame(columns).select(list(schema.keys()))
+
+    @staticmethod
+    def get_all_time_means(param_df, param_by_zip3, param_name, zip3):
+        """
+        all time means of a zip3, memoized in a bounded LRU cache keyed on param_df identity, param_name and zip3;
+        param_df must not be modified in place between calls
+        :param param_df: polars df contains data for param of interest
+        :param param_by_zip3: param_df filtered to zip3
+        :param param_name: name of param
+        :param zip3: zip3 of site measured param
+        :return: all time mean raw value and all time mean AQI
+        """
+        cache = Profiling.all_time_means_cache
+        key = (id(param_df), param_name, zip3)
+        with Profiling.all_time_means_cache_lock:
+            cached = cache.get(key)
+            # weak reference guards against a new df reusing the id of a garbage collected one
+            if cached is not None and cached[0]() is param_df:
+                cache.move_to_end(key)
+                return cached[1]
+
+        zip3_means = param_by_zip3.group_by("zip3").mean()
+        all_time_mean_raw_value = np.nan
+        if param_name != "aqi":
+            all_time_mean_raw_value = zip3_means["arithmetic_mean"][0]
+        all_time_mean_aqi = zip3_means["aqi"][0]
+        all_time_means = (all_time_mean_raw_value, all_time_mean_aqi)
+
+        with Profiling.all_time_means_cache_lock:
+            cache[key] = (weakref.ref(param_df), all_time_means)
+            cache.move_to_end(key)
+            while len(cache) > Profiling.all_time_means_cache_size:
+                cache.popitem(last=False)
 
-        aqi_dict = {f"{param_name}_all_time_mean_raw_value": np.nan,
-                    f"{param_name}_all_time_mean_aqi": np.nan,
-                    f"{param_name}_mean_value": np.nan,
-                    f"{param_name}_mean_aqi": np.nan,
-                    f"{param_name}_aqi_0to25_days": np.nan,
-                    f"{param_name}_aqi_26to50_days": np.nan,
-                    f"{param_name}_aqi_51to75_days": np.nan,
-                    f"{param_name}_aqi_76to100_days": np.nan,
-                    f"{param_name}_aqi_101to150_days": np.nan,
-                    f"{param_name}_aqi_151plus_days": np.nan,
-                    f"{param_name}_first_measured_date": datetime.date(1900, 1, 1),
-                    f"{param_name}_measured_days_before_dx": np.nan,
-                    f"{param_name}_total_measured_days": np.nan,
-                    f"{param_name}_total_dx_days": np.nan,
-                    f"{param_name}_data_coverage": np.nan}
-
-        if len(param_by_zip3) > 0:
-
-            # all time mean values
-            all_time_mean_raw_value = np.nan
-            if param_name != "aqi":
-                all_time_mean_raw_value = param_by_zip3.groupby("zip3").mean()["arithmetic_mean"][0]
-            all_time_mean_aqi = param_by_zip3.groupby("zip3").mean()["aqi"][0]
-
-            # move start_date back 365 days
-            # this to ensure measurement starts 1 year ahead
-            # in case dx period is short, e.g., few days, there should still be enough measurement data
-            dx_start_date = start_date
-            start_date = start_date - datetime.timedelta(1000)
-
-            # filter data
-            param_by_zip3_and_date = param_by_zip3.filter((pl.col(date_col) >= start_date) &
-                                                          (pl.col(date_col) <= end_date))
-
-            if len(param_by_zip3_and_date) > 0:
-                # get first measured_date before grouping
-                first_measured_date = param_by_zip3_and_date[date_col].min()
-
-                # group by zip3 & date and get mean value
-                param_by_zip3_and_date = param_by_zip3_and_date.groupby([date_col, "zip3"]).mean()
-
-                # days by thresholds
-                sub25days = len(param_by_zip3_and_date.filter(pl.col("aqi") <= 25))
-                sub50days = len(param_by_zip3_and_date.filter(pl.col("aqi") <= 50))
-                sub75days = len(param_by_zip3_and_date.filter(pl.col("aqi") <= 75))
-                sub100days = len(param_by_zip3_and_date.filter(pl.col("aqi") <= 100))
-                sub150days = len(param_by_zip3_and_date.filter(pl.col("aqi") <= 150))
-
-                # days by bins
-                total_measured_days = len(param_by_zip3_and_date)
-                aqi26to50days = sub50days - sub25days
-                aqi51to75days = sub75days - sub50days
-                aqi76to100days = sub100days - sub75days
-                aqi101to150days = sub150days - sub100days
-                above150days = total_measured_days - sub150days
-
-                # other stats
-                mean_raw_value = np.nan
-                if param_name != "aqi":
-                    mean_raw_value = param_by_zip3_and_date.groupby("zip3").mean()["arithmetic_mean"][0]
-                mean_aqi = param_by_zip3_and_date.groupby("zip3").mean()["aqi"][0]
-                days_before_dx = len(param_by_zip3_and_date.filter(pl.col(date_col) <= dx_start_date))
-                dx_days = (end_date - dx_start_date).days + 1
-                data_coverage = total_measured_days / dx_days
-
-                # put all together
-                aqi_dict = {f"{param_name}_all_time_mean_raw_value": all_time_mean_raw_value,
-                            f"{param_name}_all_time_mean_aqi": all_time_mean_aqi,
-                            f"{param_name}_mean_raw_value": mean_raw_value,
-                            f"{param_name}_mean_aqi": mean_aqi,
-                            f"{param_name}_aqi_0to25_days": sub25days,
-                            f"{param_name}_aqi_26to50_days": aqi26to50days,
-                            f"{param_name}_aqi_51to75_days": aqi51to75days,
-                            f"{param_name}_aqi_76to100_days": aqi76to100days,
-                            f"{param_name}_aqi_101to150_days": aqi101to150days,
-                            f"{param_name}_aqi_151plus_days": above150days,
-                            f"{param_name}_first_measured_date": first_measured_date,
-                            f"{param_name}_measured_days_before_dx": days_before_dx,
-                            f"{param_name}_total_measured_days": total_measured_days,
-                            f"{param_name}_total_dx_days": dx_days,
-                            f"{param_name}_data_coverage": data_coverage}
+        return all_time_means
+
+    @staticmethod
+    def get_aqi_columnar(participant_dx_period, param_df, param_name, date_col):
+        """
+        columnar equivalent of get_aqi: profiles all participant rows at once with polars expressions;
+        daily zip3 means become running sums by zip3, and each window looks up running sums at its ends
+        with as-of joins, so windows are never expanded into their days
+        :param participant_dx_period: participant df containing person_id, zip3, start_date and end_date
+        :param param_df: polars df contains data for param of interest
+        :param param_name: name of param
+        :param date_col: column name of date
+        :return: polars df with AQI related data, one row per participant row, same schema as get_aqi results
+        """
+
+        if len(participant_dx_period) == 0:
+            return pl.DataFrame(schema=Profiling.aqi_schema(param_name))
+
+        value_cols = ["aqi"]
+        if param_name != "aqi":
+            value_cols.append("arithmetic_mean")
+
+        def to_day(col):
+            return pl.col(col).cast(pl.Date).to_physical().cast(pl.Int32)
+
+        windows = participant_dx_period.select(["person_id", "zip3", "start_date", "end_date"])
+        windows = windows.with_columns(pl.Series("row_nr", np.arange(len(windows), dtype=np.uint32)),
+                                       to_day("start_date").alias("start_day"),
+                                       to_day("end_date").alias("end_day"))
+        windows = windows.with_columns((pl.col("start_day") - DX_LOOKBACK_DAYS).alias("window_start_day"),
+                                       (pl.col("start_day") - DX_LOOKBACK_DAYS - 1).alias("before_window_day"))
+
+        # only scan zip3s and dates participants need; all time means still use all dates of a zip3
+        param_by_zip3 = param_df.lazy().filter(pl.col("zip3").is_in(windows["zip3"].unique()))
+        all_time_means = param_by_zip3.group_by("zip3").agg([pl.col(c).mean().alias(f"all_time_{c}")
+                                                             for c in value_cols])
+
+        # running sums of daily means by zip3; a window's value is its running sum at end_day
+        # minus its running sum at the day before the window
+        aqi = pl.col("aqi")
+        bounds = AQIIndex.bin_bounds
+        running_cols = {"measured_days": pl.col("day").is_not_null(),
+                        "aqi_sum": aqi.fill_null(0.0),
+                        "aqi_count": aqi.is_not_null()}
+        if param_name != "aqi":
+            running_cols.update({"raw_value_sum": pl.col("arithmetic_mean").fill_null(0.0),
+                                 "raw_value_count": pl.col("arithmetic_mean").is_not_null()})
+        # days without AQI fall into no bin
+        running_cols.update({f"sub{bound}days": (aqi <= bound).fill_null(False) for bound in bounds})
+        running_cols[f"above{bounds[-1]}days"] = (aqi > bounds[-1]).fill_null(False)
+        window_start = participant_dx_period["start_date"].min() - datetime.timedelta(DX_LOOKBACK_DAYS)
+        # collected once, as all four lookups below join to it
+        running_sums = (param_by_zip3
+                        .filter((pl.col(date_col) >= window_start) & (pl.col(date_col) <= windows["end_date"].max()))
+                        .group_by([date_col, "zip3"])
+                        .agg([pl.col(c).mean() for c in value_cols])
+                        # all-null zip3-days have no daily mean, as in get_aqi
+                        .with_columns(pl.col(value_cols).fill_nan(None), to_day(date_col).alias("day"))
+                        .sort(["zip3", "day"])
+                        .select(["zip3", "day"] +
+                                [(expr if col.endswith("_sum") else expr.cast(pl.Int64))
+                                 .cum_sum().over("zip3").alias(col) for col, expr in running_cols.items()])
+                        .sort("day")
+                        .collect(streaming=True)
+                        .lazy())
+
+        def running_sums_at(day_col, cols, suffix, strategy="backward"):
+            # as-of join finds the last measured day of the window's zip3 on or before day_col,
+            # or with forward strategy the first one on or after it
+            return (windows.lazy()
+                    .select(["row_nr", "zip3", pl.col(day_col).alias("day")])
+                    .sort("day")
+                    .join_asof(running_sums.select(["zip3", "day", pl.col("day").alias("matched_day")] + cols),
+                               on="day", by="zip3", strategy=strategy)
+                    .select(["row_nr"] + [pl.col(c).alias(f"{c}{suffix}") for c in ["matched_day"] + cols]))
+
+        sum_cols = list(running_cols.keys())
+        stats = (windows.lazy()
+                 .join(running_sums_at("end_day", sum_cols, "_end"), how="left", on="row_nr")
+                 .join(running_sums_at("before_window_day", sum_cols, "_before"), how="left", on="row_nr")
+                 .join(running_sums_at("start_day", ["measured_days"], "_dx"), how="left", on="row_nr")
+                 .join(running_sums_at("window_start_day", [], "_first", strategy="forward"),
+                       how="left", on="row_nr")
+                 .with_columns([(pl.col(f"{c}_end").fill_null(0) - pl.col(f"{c}_before").fill_null(0)).alias(c)
+                                for c in sum_cols] +
+                               [(pl.col("measured_days_dx").fill_null(0) - pl.col("measured_days_before").fill_null(0))
+                                .alias("days_before_dx")]))
+
+        all_time_raw_value = pl.lit(np.nan)
+        mean_raw_value = pl.lit(np.nan)
+        if param_name != "aqi":
+            all_time_raw_value = pl.col("all_time_arithmetic_mean")
+            mean_raw_value = pl.col("raw_value_sum") / pl.col("raw_value_count")
+
+        # participant rows without measurement in their window keep NaN/1900-01-01 defaults, as in get_aqi
+        measured = pl.col("measured_days") > 0
+        dx_days = pl.col("end_day") - pl.col("start_day") + 1
+
+        def or_nan(expr):
+            return pl.when(measured).then(expr).otherwise(np.nan).cast(pl.Float64).fill_null(np.nan)
+
+        def bin_days(low, high):
+            return or_nan(pl.col(f"sub{high}days") - pl.col(f"sub{low}days"))
+
+        aqi_df = (stats
+                  .join(all_time_means, how="left", on="zip3")
+                  .sort("row_nr")
+                  .select([or_nan(all_time_raw_value).alias(f"{param_name}_all_time_mean_raw_value"),
+                           or_nan(pl.col("all_time_aqi")).alias(f"{param_name}_all_time_mean_aqi"),
+                           or_nan(mean_raw_value).alias(f"{param_name}_mean_raw_value"),
+                           or_nan(pl.col("aqi_sum") / pl.col("aqi_count")).alias(f"{param_name}_mean_aqi"),
+                           or_nan(pl.col(f"sub{bounds[0]}days")).alias(f"{param_name}_aqi_0to25_days"),
+                           bin_days(bounds[0], bounds[1]).alias(f"{param_name}_aqi_26to50_days"),
+                           bin_days(bounds[1], bounds[2]).alias(f"{param_name}_aqi_51to75_days"),
+                           bin_days(bounds[2], bounds[3]).alias(f"{param_name}_aqi_76to100_days"),
+                           bin_days(bounds[3], bounds[4]).alias(f"{param_name}_aqi_101to150_days"),
+                           or_nan(pl.col(f"above{bounds[4]}days")).alias(f"{param_name}_aqi_151plus_days"),
+                           pl.when(measured).then(pl.col("matched_day_first").cast(pl.Date))
+                           .otherwise(datetime.date(1900, 1, 1))
+                           .alias(f"{param_name}_first_measured_date"),
+                           or_nan(pl.col("days_before_dx")).alias(f"{param_name}_measured_days_before_dx"),
+                           or_nan(pl.col("measured_days")).alias(f"{param_name}_total_measured_days"),
+                           or_nan(dx_days).alias(f"{param_name}_total_dx_days"),
+                           or_nan(pl.col("measured_days") / dx_days).alias(f"{param_name}_data_coverage"),
+                           pl.col("person_id").cast(pl.Utf8)])
+                  .collect(streaming=True))
+
+        return aqi_df
+
+
+class AQIIndex:
+    """
+    daily AQI index of one EPA parameter, built once and queried for any number of date windows;
+    daily means are sorted by zip3 and date and stored as prefix sums,
+    so each window query is two binary searches and a few array subtractions
+    """
+
+    # upper AQI bound of each bin; days above the last bound fall into the 151plus bin
+    bin_bounds = (25, 50, 75, 100, 150)
+
+    def __init__(self, param_df, param_name, date_col="date", participant_dx_period=None):
+        """
+        :param param_df: polars df or lazy frame contains data for param of interest
+        :param param_name: name of param
+        :param date_col: column name of date
+        :param participant_dx_period: defaults to None; if given, only zip3s and dates its windows need are indexed,
+                                      all time means still use all dates of these zip3s
+        """
+        self.param_name = param_name
+
+        value_cols = ["aqi"]
+        if param_name != "aqi":
+            value_cols.append("arithmetic_mean")
+
+        param_df = param_df.lazy()
+        daily_df = param_df
+        if participant_dx_period is not None:
+            param_df = param_df.filter(pl.col("zip3").is_in(participant_dx_period["zip3"].unique()))
+            daily_df = param_df
+            # without participant rows, the zip3 filter already leaves nothing to index
+            if len(participant_dx_period) > 0:
+                window_start = participant_dx_period["start_date"].min() - datetime.timedelta(DX_LOOKBACK_DAYS)
+                daily_df = param_df.filter((pl.col(date_col) >= window_start) &
+                                           (pl.col(date_col) <= participant_dx_period["end_date"].max()))
+
+        all_time_means = (param_df.group_by("zip3")
+                          .agg([pl.col(c).mean().alias(f"all_time_{c}") for c in value_cols])
+                          .sort("zip3")
+                          .collect(streaming=True))
+
+        # zip3 lookup; zip3 codes follow zip3 sort order
+        self.zip3_codes = all_time_means.select("zip3").with_columns(
+            pl.Series("zip3_code", np.arange(len(all_time_means), dtype=np.int64)))
+        daily_means = (daily_df.with_columns(pl.col(date_col).cast(pl.Date).alias("date"))
+                       .group_by(["zip3", "date"])
+                       .agg([pl.col(c).mean() for c in value_cols])
+                       .join(self.zip3_codes.lazy(), how="inner", on="zip3")
+                       .sort(["zip3_code", "date"])
+                       .collect(streaming=True))
+
+        # all time means, by zip3 code
+        self.all_time_mean_aqi = all_time_means["all_time_aqi"].to_numpy().astype(np.float64)
+        if param_name != "aqi":
+            self.all_time_mean_raw_value = all_time_means["all_time_arithmetic_mean"].to_numpy().astype(np.float64)
+        else:
+            self.all_time_mean_raw_value = np.full(len(all_time_means), np.nan)
+
+        # sorted search keys combine zip3 code and day number, so one searchsorted covers all zip3s
+        self.days = daily_means["date"].to_physical().to_numpy().astype(np.int64)
+        self.keys = self._keys(daily_means["zip3_code"].to_numpy(), self.days)
+
+        # prefix sums with a leading zero, so a window [i, j) sums to cum[j] - cum[i]
+        aqi = daily_means["aqi"].to_numpy().astype(np.float64)
+        self.cum_aqi, self.cum_aqi_count = self._cumsum(aqi)
+        if param_name != "aqi":
+            raw_value = daily_means["arithmetic_mean"].to_numpy().astype(np.float64)
+            self.cum_raw_value, self.cum_raw_value_count = self._cumsum(raw_value)
+        # days without AQI, i.e., NaN, fall into no bin
+        self.cum_bins = [np.concatenate([[0], np.cumsum(aqi <= bound)]) for bound in self.bin_bounds]
+
+    @staticmethod
+    def _keys(zip3_codes, days):
+        return (np.asarray(zip3_codes, dtype=np.int64) << 32) + np.asarray(days, dtype=np.int64)
+
+    @staticmethod
+    def _cumsum(values):
+        is_valid = ~np.isnan(values)
+        cum_sum = np.concatenate([[0.0], np.cumsum(np.where(is_valid, values, 0.0))])
+        cum_count = np.concatenate([[0], np.cumsum(is_valid)])
+        return cum_sum, cum_count
+
+    def window_aggregates(self, zip3_codes, start_days, end_days):
+        """
+        :param zip3_codes: numpy array of zip3 codes; -1 for zip3s without data
+        :param start_days: numpy array of diagnosis start dates as days since epoch
+        :param end_days: numpy array of diagnosis end dates as days since epoch
+        :return: dict of numpy arrays with running aggregates of each window: sums and counts of AQI and raw value,
+                 days by AQI bin, measured days before dx, total measured days, and first measured day (-1 if none)
+        """
+        zip3_codes = np.asarray(zip3_codes, dtype=np.int64)
+        start_days = np.asarray(start_days, dtype=np.int64)
+        end_days = np.asarray(end_days, dtype=np.int64)
+
+        lo = np.searchsorted(self.keys, self._keys(zip3_codes, start_days - DX_LOOKBACK_DAYS), side="left")
+        hi = np.searchsorted(self.keys, self._keys(zip3_codes, end_days), side="right")
+        dx = np.searchsorted(self.keys, self._keys(zip3_codes, start_days), side="right")
+        hi = np.where(zip3_codes >= 0, hi, lo)
+        total_measured_days = hi - lo
+
+        sub_bounds = [cum_bin[hi] - cum_bin[lo] for cum_bin in self.cum_bins]
+        bin_days = [sub_bounds[0]] + [sub_bounds[k] - sub_bounds[k - 1] for k in range(1, len(sub_bounds))]
+        aqi_count = self.cum_aqi_count[hi] - self.cum_aqi_count[lo]
+        bin_days.append(aqi_count - sub_bounds[-1])
+
+        if self.param_name != "aqi":
+            raw_value_sum = self.cum_raw_value[hi] - self.cum_raw_value[lo]
+            raw_value_count = self.cum_raw_value_count[hi] - self.cum_raw_value_count[lo]
+        else:
+            raw_value_sum = np.zeros(len(lo))
+            raw_value_count = np.zeros(len(lo), dtype=np.int64)
+
+        return {"aqi_sum": self.cum_aqi[hi] - self.cum_aqi[lo],
+                "aqi_count": aqi_count,
+                "raw_value_sum": raw_value_sum,
+                "raw_value_count": raw_value_count,
+                "aqi_0to25_days": bin_days[0],
+                "aqi_26to50_days": bin_days[1],
+                "aqi_51to75_days": bin_days[2],
+                "aqi_76to100_days": bin_days[3],
+                "aqi_101to150_days": bin_days[4],
+                "aqi_151plus_days": bin_days[5],
+                "measured_days_before_dx": np.minimum(dx, hi) - lo,
+                "total_measured_days": total_measured_days,
+                "first_measured_day": np.where(total_measured_days > 0,
+                                               self.days[np.minimum(lo, len(self.days) - 1)] if len(self.days) else -1,
+                                               -1)}
+
+    @staticmethod
+    def aggregates_to_stats(aggregates, all_time_mean_raw_value, all_time_mean_aqi, start_days, end_days):
+        """
+        :param aggregates: output of window_aggregates
+        :param all_time_mean_raw_value: numpy array of all time mean raw value of each window's zip3
+        :param all_time_mean_aqi: numpy array of all time mean AQI of each window's zip3
+        :param start_days: numpy array of diagnosis start dates as days since epoch
+        :param end_days: numpy array of diagnosis end dates as days since epoch
+        :return: dict of numpy arrays with AQI related data; NaN where window has no measurement
+        """
+        total_measured_days = aggregates["total_measured_days"]
+        measured = total_measured_days > 0
+
+        def or_nan(values):
+            return np.where(measured, values, np.nan)
+
+        def mean(value_sum, value_count):
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return np.where(value_count > 0, value_sum / value_count, np.nan)
+
+        dx_days = np.asarray(end_days, dtype=np.int64) - np.asarray(start_days, dtype=np.int64) + 1
+
+        return {"all_time_mean_raw_value": or_nan(all_time_mean_raw_value),
+                "all_time_mean_aqi": or_nan(all_time_mean_aqi),
+                "mean_raw_value": or_nan(mean(aggregates["raw_value_sum"], aggregates["raw_value_count"])),
+                "mean_aqi": or_nan(mean(aggregates["aqi_sum"], aggregates["aqi_count"])),
+                "aqi_0to25_days": or_nan(aggregates["aqi_0to25_days"]),
+                "aqi_26to50_days": or_nan(aggregates["aqi_26to50_days"]),
+                "aqi_51to75_days": or_nan(aggregates["aqi_51to75_days"]),
+                "aqi_76to100_days": or_nan(aggregates["aqi_76to100_days"]),
+                "aqi_101to150_days": or_nan(aggregates["aqi_101to150_days"]),
+                "aqi_151plus_days": or_nan(aggregates["aqi_151plus_days"]),
+                "first_measured_day": aggregates["first_measured_day"],
+                "measured_days_before_dx": or_nan(aggregates["measured_days_before_dx"]),
+                "total_measured_days": or_nan(total_measured_days),
+                "total_dx_days": or_nan(dx_days),
+                "data_coverage": or_nan(total_measured_days / dx_days)}
+
+    @staticmethod
+    def stats_frame(param_name, stats, person_id):
+        """
+        :param param_name: name of param
+        :param stats: output of window_stats or aggregates_to_stats
+        :param person_id: polars series of person_id of each window
+        :return: polars df with AQI related data, same schema as get_aqi results
+        """
+        aqi_df = pl.DataFrame({f"{param_name}_{k}": v for k, v in stats.items()})
+        first_measured_day = pl.col(f"{param_name}_first_measured_day")
+        aqi_df = aqi_df.with_columns(pl.when(first_measured_day >= 0)
+                                     .then(first_measured_day.cast(pl.Int32).cast(pl.Date))
+                                     .otherwise(datetime.date(1900, 1, 1))
+                                     .alias(f"{param_name}_first_measured_date"),
+                                     person_id.cast(pl.Utf8).alias("person_id"))
+
+        return aqi_df.select(list(Profiling.aqi_schema(param_name).keys()))
+
+    def window_stats(self, zip3_codes, start_days, end_days):
+        """
+        :param zip3_codes: numpy array of zip3 codes; -1 for zip3s without data
+        :param start_days: numpy array of diagnosis start dates as days since epoch
+        :param end_days: numpy array of diagnosis end dates as days since epoch
+        :return: dict of numpy arrays with AQI related data; NaN where window has no measurement
+        """
+        aggregates = self.window_aggregates(zip3_codes, start_days, end_days)
+        zip3_codes = np.asarray(zip3_codes, dtype=np.int64)
+
+        def by_zip3_code(values):
+            # an index of no zip3s has nothing to look up
+            if len(values) == 0:
+                return np.full(len(zip3_codes), np.nan)
+            return np.where(zip3_codes >= 0, values[np.maximum(zip3_codes, 0)], np.nan)
+
+        return self.aggregates_to_stats(aggregates,
+                                        by_zip3_code(self.all_time_mean_raw_value),
+                                        by_zip3_code(self.all_time_mean_aqi),
+                                        start_days, end_days)
+
+    def query(self, start_date, end_date, zip3, person_id=None):
+        """
+        same as Profiling.get_aqi, using the prebuilt index
+        :param start_date: start date of param data
+        :param end_date: end date of param data
+        :param zip3: zip3 of site measured param
+        :param person_id: defaults to None; person id of interest
+        :return: new columns with AQI related data
+        """
+        zip3_code = self.zip3_codes.filter(pl.col("zip3") == zip3)["zip3_code"]
+        zip3_code = zip3_code[0] if len(zip3_code) > 0 else -1
+        epoch = datetime.date(1970, 1, 1)
+        stats = self.window_stats([zip3_code], [(start_date - epoch).days], [(end_date - epoch).days])
+
+        aqi_dict = {}
+        for k, v in stats.items():
+            if k == "first_measured_day":
+                first_measured_date = datetime.date(1900, 1, 1)
+                if v[0] >= 0:
+                    first_measured_date = epoch + datetime.timedelta(int(v[0]))
+                aqi_dict[f"{self.param_name}_first_measured_date"] = first_measured_date
+            else:
+                aqi_dict[f"{self.param_name}_{k}"] = float(v[0])
 
         if person_id:
             aqi_dict["person_id"] = person_id
 
         return aqi_dict
+
+    def lookup_zip3_codes(self, windows):
+        """
+        :param windows: output of Profiling.prepare_windows
+        :return: numpy array of zip3 code of each participant row; -1 for zip3s without data
+        """
+        # map unique participant zip3s to index zip3 codes, then broadcast to rows
+        unique_zip3_codes = (windows["unique_zip3"].to_frame()
+                             .join(self.zip3_codes, how="left", on="zip3")["zip3_code"]
+                             .fill_null(-1)
+                             .to_numpy())
+        zip3_position = windows["zip3_position"]
+        if len(unique_zip3_codes) == 0:
+            return np.full(len(zip3_position), -1, dtype=np.int64)
+
+        return np.where(zip3_position >= 0, unique_zip3_codes[np.maximum(zip3_position, 0)], -1)
+
+    def query_many(self, participant_dx_period, windows=None):
+        """
+        :param participant_dx_period: participant df containing person_id, zip3, start_date and end_date
+        :param windows: defaults to None; output of Profiling.prepare_windows for participant_dx_period
+        :return: polars df with AQI related data, one row per participant row, same schema as get_aqi results
+        """
+        if windows is None:
+            windows = Profiling.prepare_windows(participant_dx_period)
+
+        stats = self.window_stats(self.lookup_zip3_codes(windows), windows["start_days"], windows["end_days"])
+
+        return self.stats_frame(self.param_name, stats, windows["person_id"])
+
+
+class ProfileStore:
+    """
+    persistent AQI profile of one EPA parameter, kept as running aggregates:
+    daily and all time sums and counts by zip3, and window aggregates by participant row;
+    new or revised EPA days, or new participants, only recompute the participant windows they affect
+    """
+
+    aggregate_cols = ("aqi_sum", "aqi_count", "raw_value_sum", "raw_value_count",
+                      "aqi_0to25_days", "aqi_26to50_days", "aqi_51to75_days", "aqi_76to100_days",
+                      "aqi_101to150_days", "aqi_151plus_days",
+                      "measured_days_before_dx", "total_measured_days", "first_measured_day")
+
+    def __init__(self, param_name):
+        """
+        :param param_name: name of param
+        """
+        self.param_name = param_name
+        sum_schema = {"aqi_sum": pl.Float64, "aqi_count": pl.Int64,
+                      "raw_value_sum": pl.Float64, "raw_value_count": pl.Int64}
+        self.daily = pl.DataFrame(schema={"zip3": pl.Utf8, "date": pl.Date, **sum_schema})
+        self.zip3_totals = pl.DataFrame(schema={"zip3": pl.Utf8, **sum_schema})
+        # participant rows with window aggregates in agg_ prefixed columns
+        self.windows = None
+
+    @classmethod
+    def create(cls, participant_dx_period, epa_data, param_name):
+        """
+        :param participant_dx_period: participant df containing diagnosis period
+        :param epa_data: EPA df of interest, or a lazy frame or Parquet/IPC file path of it
+        :param param_name: environmental parameter of interest
+        :return: new ProfileStore
+        """
+        store = cls(param_name)
+        store.update_epa_data(epa_data)
+        store.update_participants(participant_dx_period)
+
+        return store
+
+    def _sums(self, epa_data, by):
+        value_sums = [pl.col("aqi").sum().alias("aqi_sum"),
+                      pl.col("aqi").is_not_null().sum().cast(pl.Int64).alias("aqi_count")]
+        if self.param_name != "aqi":
+            value_sums += [pl.col("arithmetic_mean").sum().alias("raw_value_sum"),
+                           pl.col("arithmetic_mean").is_not_null().sum().cast(pl.Int64).alias("raw_value_count")]
+        else:
+            value_sums += [pl.lit(0.0).alias("raw_value_sum"), pl.lit(0, dtype=pl.Int64).alias("raw_value_count")]
+
+        return epa_data.group_by(by).agg(value_sums)
+
+    @staticmethod
+    def _merge_sums(sums, new_sums, by):
+        return (pl.concat([sums, new_sums.select(sums.columns).cast(sums.schema)])
+                .group_by(by)
+                .agg(pl.all().sum())
+                .sort(by))
+
+    def update_epa_data(self, epa_data, date_col="date"):
+        """
+        merge EPA rows, e.g., new measured days; rows of a zip3 and day already in store replace its stored data,
+        so re-delivered or revised days are not counted twice
+        :param epa_data: EPA df, or a lazy frame or Parquet/IPC file path of it, with all rows of each day it has
+        :param date_col: column name of date
+        :return: number of participant windows recomputed
+        """
+        epa_data = (Profiling.scan_epa_data(epa_data)
+                    .with_columns(pl.col(date_col).cast(pl.Date).alias("date"), pl.col("zip3").cast(pl.Utf8)))
+        new_daily = self._sums(epa_data, ["zip3", "date"]).collect(streaming=True)
+        new_zip3_totals = self._sums(epa_data, "zip3").collect(streaming=True)
+
+        # stored sums of incoming zip3-days are taken out of all time totals, then replaced
+        new_days = new_daily.select(["zip3", "date"])
+        replaced_zip3_totals = (self.daily.join(new_days, how="semi", on=["zip3", "date"])
+                                .group_by("zip3")
+                                .agg([-pl.col(c).sum() for c in self.zip3_totals.columns if c != "zip3"]))
+        self.daily = self._merge_sums(self.daily.join(new_days, how="anti", on=["zip3", "date"]),
+                                      new_daily, ["zip3", "date"])
+        self.zip3_totals = self._merge_sums(self._merge_sums(self.zip3_totals, new_zip3_totals, "zip3"),
+                                            replaced_zip3_totals, "zip3")
+
+        if self.windows is None or len(new_daily) == 0:
+            return 0
+
+        # windows whose zip3 got new days within their date range
+        new_date_ranges = new_daily.group_by("zip3").agg(pl.col("date").min().alias("new_start_date"),
+                                                         pl.col("date").max().alias("new_end_date"))
+        affected = (self.windows.select("zip3", "start_date", "end_date")
+                    .join(new_date_ranges, how="left", on="zip3")
+                    .select((pl.col("start_date") - pl.duration(days=DX_LOOKBACK_DAYS) <= pl.col("new_end_date")) &
+                            (pl.col("end_date") >= pl.col("new_start_date")))
+                    .to_series()
+                    .fill_null(False))
+        n_affected = int(affected.sum())
+        if n_affected > 0:
+            affected_rows = np.flatnonzero(affected.to_numpy())
+            aggregates = self.window_aggregates(self.windows[affected_rows])
+            for col, values in aggregates.items():
+                self.windows = self.windows.with_columns(self.windows[f"agg_{col}"].scatter(affected_rows, values))
+
+        return n_affected
+
+    def update_participants(self, participant_dx_period):
+        """
+        add participant rows; all existing rows of their person_ids are replaced
+        :param participant_dx_period: participant df containing diagnosis period of new or changed participants
+        :return: number of participant windows computed
+        """
+        aggregates = self.window_aggregates(participant_dx_period)
+        new_windows = participant_dx_period.with_columns([pl.Series(f"agg_{col}", aggregates[col])
+                                                          for col in self.aggregate_cols])
+
+        if self.windows is None:
+            self.windows = new_windows
+        else:
+            self.windows = pl.concat([self.windows.filter(~pl.col("person_id").is_in(new_windows["person_id"])),
+                                      new_windows.select(self.windows.columns).cast(self.windows.schema)])
+
+        return len(new_windows)
+
+    def window_aggregates(self, participant_dx_period):
+        """
+        :param participant_dx_period: participant df containing person_id, zip3, start_date and end_date
+        :return: dict of numpy arrays, see AQIIndex.window_aggregates
+        """
+        windows = Profiling.prepare_windows(participant_dx_period)
+        daily_means = (self.daily.filter(pl.col("zip3").is_in(windows["unique_zip3"].cast(pl.Utf8)))
+                       .select("zip3", "date",
+                               pl.when(pl.col("aqi_count") > 0)
+                               .then(pl.col("aqi_sum") / pl.col("aqi_count"))
+                               .alias("aqi"),
+                               pl.when(pl.col("raw_value_count") > 0)
+                               .then(pl.col("raw_value_sum") / pl.col("raw_value_count"))
+                               .alias("arithmetic_mean")))
+        index = AQIIndex(daily_means, self.param_name, "date", participant_dx_period=participant_dx_period)
+
+        return index.window_aggregates(index.lookup_zip3_codes(windows), windows["start_days"], windows["end_days"])
+
+    def profile(self):
+        """
+        :return: participant rows with param aqi ratio added, same columns as Profiling.create_epa_param_profile
+        """
+        aggregates = {col: self.windows[f"agg_{col}"].to_numpy() for col in self.aggregate_cols}
+        all_time_means = (self.windows.select(pl.col("zip3").cast(pl.Utf8))
+                          .join(self.zip3_totals, how="left", on="zip3")
+                          .select((pl.col("raw_value_sum") / pl.col("raw_value_count")).fill_null(np.nan)
+                                  .alias("raw_value"),
+                                  (pl.col("aqi_sum") / pl.col("aqi_count")).fill_null(np.nan).alias("aqi")))
+        start_days = self.windows["start_date"].cast(pl.Date).to_physical().to_numpy()
+        end_days = self.windows["end_date"].cast(pl.Date).to_physical().to_numpy()
+        stats = AQIIndex.aggregates_to_stats(aggregates,
+                                             all_time_means["raw_value"].to_numpy(),
+                                             all_time_means["aqi"].to_numpy(),
+                                             start_days, end_days)
+        aqi_df = AQIIndex.stats_frame(self.param_name, stats, self.windows["person_id"])
+
+        participant_cols = [col for col in self.windows.columns if not col.startswith("agg_")]
+        return self.windows.select(participant_cols).hstack(aqi_df.drop("person_id").get_columns())
+
+    def save(self, path):
+        """
+        :param path: directory to save store in
+        """
+        os.makedirs(path, exist_ok=True)
+        pl.DataFrame({"param_name": [self.param_name]}).write_parquet(os.path.join(path, "store.parquet"))
+        self.daily.write_parquet(os.path.join(path, "daily.parquet"))
+        self.zip3_totals.write_parquet(os.path.join(path, "zip3_totals.parquet"))
+        if self.windows is not None:
+            self.windows.write_parquet(os.path.join(path, "windows.parquet"))
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: directory store was saved in
+        :return: ProfileStore
+        """
+        store = cls(pl.read_parquet(os.path.join(path, "store.parquet"))["param_name"][0])
+        store.daily = pl.read_parquet(os.path.join(path, "daily.parquet"))
+        store.zip3_totals = pl.read_parquet(os.path.join(path, "zip3_totals.parquet"))
+        if os.path.exists(os.path.join(path, "windows.parquet")):
+            store.windows = pl.read_parquet(os.path.join(path, "windows.parquet"))
+
+        return store
+
+
+def _profile_partition(participant_dx_period, epa_path, param_name, profile_type, engine):
+    """
+    process pool worker of Profiling.profile_param_partitions
+    :param participant_dx_period: participant df of one partition
+    :param epa_path: path of Arrow IPC file with EPA data of partition zip3s
+    :param param_name: environmental parameter of interest
+    :param profile_type: accepts "aqi"
+    :param engine: see Profiling.create_epa_param_profile
+    :return: df of param aqi ratio of partition
+    """
+    epa_data = pl.read_ipc(epa_path, memory_map=True)
+
+    return Profiling().profile_param(participant_dx_period, epa_data, param_name, profile_type, engine,
+                                     backend="serial")
@@ -0,0 +1,195 @@
+from contextlib import contextmanager
+
+import logging
+import os
+import polars as pl
+import resource
+import threading
+import time
+
+
+def rss_bytes():
+    """
+    :return: current resident set size of this process, or peak so far where /proc is not available
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    """
+    :return: peak resident set size of this process so far
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Instrumentation:
+    """
+    opt-in timers of hot path stages; each timed stage is recorded as an event with seconds, row count,
+    rows/sec throughput and process peak RSS, passed to callback and logger, and added to running totals by stage
+    """
+
+    # seconds a peak RSS reading is reused for, so short stages do not each make a system call
+    peak_rss_interval = 0.1
+
+    def __init__(self, callback=None, logger=None, enabled=True, keep_events=False):
+        """
+        :param callback: defaults to None; function called with each event dict
+        :param logger: defaults to None; logging.Logger each event is logged to at DEBUG level
+        :param enabled: defaults to True; if False, stages are not timed or recorded
+        :param keep_events: defaults to False; if True, every event dict is also kept in events;
+                            otherwise only running totals by stage are kept for summary
+        """
+        self.callback = callback
+        self.logger = logger
+        self.enabled = enabled
+        self.keep_events = keep_events
+        self.events = []
+        # stage name to [calls, seconds, rows, peak RSS bytes], in first seen order
+        self.stage_totals = {}
+        self._peak_rss = (0, 0.0)
+        self._lock = threading.Lock()
+
+    def peak_rss_bytes(self):
+        """
+        :return: peak RSS of this process, read at most once per peak_rss_interval
+        """
+        peak_rss, read_at = self._peak_rss
+        now = time.perf_counter()
+        if now - read_at >= self.peak_rss_interval:
+            peak_rss = peak_rss_bytes()
+            self._peak_rss = (peak_rss, now)
+
+        return peak_rss
+
+    def record(self, stage, seconds, rows=None):
+        """
+        :param stage: stage name
+        :param seconds: seconds spent in stage
+        :param rows: defaults to None; rows processed in stage
+        :return: event dict, None if no callback, logger or kept events need it
+        """
+        peak_rss = self.peak_rss_bytes()
+        with self._lock:
+            totals = self.stage_totals.get(stage)
+            if totals is None:
+                totals = self.stage_totals[stage] = [0, 0.0, 0, 0]
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += rows or 0
+            totals[3] = max(totals[3], peak_rss)
+
+        log = self.logger is not None and self.logger.isEnabledFor(logging.DEBUG)
+        if not (self.keep_events or self.callback is not None or log):
+            return None
+
+        rows_per_second = None
+        if rows is not None and seconds > 0:
+            rows_per_second = rows / seconds
+        event = {"stage": stage,
+                 "seconds": seconds,
+                 "rows": rows,
+                 "rows_per_second": rows_per_second,
+                 "peak_rss_bytes": peak_rss}
+
+        if self.keep_events:
+            with self._lock:
+                self.events.append(event)
+        if self.callback is not None:
+            self.callback(event)
+        if log:
+            self.logger.debug("%(stage)s: %(seconds).4fs, rows=%(rows)s, rows/s=%(rows_per_second)s", event)
+
+        return event
+
+    @contextmanager
+    def stage(self, stage, rows=None):
+        """
+        time a block of code; row count can also be set on the yielded dict inside the block
+        :param stage: stage name
+        :param rows: defaults to None; rows processed in stage
+        """
+        info = {"rows": rows}
+        if not self.enabled:
+            yield info
+            return
+
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            self.record(stage, time.perf_counter() - start, info["rows"])
+
+    def timer(self):
+        """
+        :return: StageTimer timing consecutive stages of straight-line code
+        """
+        return StageTimer(self)
+
+    def summary(self):
+        """
+        :return: polars df of calls, total seconds, total rows, rows/sec and peak RSS by stage, in first seen order
+        """
+        with self._lock:
+            stage_totals = [(stage, *totals) for stage, totals in self.stage_totals.items()]
+
+        summary = pl.DataFrame(stage_totals, orient="row",
+                               schema={"stage": pl.Utf8, "calls": pl.UInt32, "seconds": pl.Float64,
+                                       "rows": pl.Int64, "peak_rss_bytes": pl.Int64})
+        rows_per_second = pl.when(pl.col("seconds") > 0).then(pl.col("rows") / pl.col("seconds"))
+        summary = (summary.with_columns(rows_per_second.alias("rows_per_second"))
+                   .select(["stage", "calls", "seconds", "rows", "rows_per_second", "peak_rss_bytes"]))
+
+        return summary
+
+    def report(self):
+        """
+        :return: summary as printable text
+        """
+        lines = [f"{'stage':<28}{'calls':>8}{'seconds':>12}{'rows':>14}{'rows/s':>14}{'peak RSS MiB':>14}"]
+        for row in self.summary().iter_rows(named=True):
+            rows_per_second = f"{row['rows_per_second']:.0f}" if row["rows_per_second"] else "-"
+            lines.append(f"{row['stage']:<28}{row['calls']:>8}{row['seconds']:>12.4f}{row['rows'] or 0:>14}"
+                         f"{rows_per_second:>14}{row['peak_rss_bytes'] / 1024 ** 2:>14.1f}")
+
+        return "\n".join(lines)
+
+    def reset(self):
+        """
+        remove all recorded events and stage totals
+        """
+        with self._lock:
+            self.events = []
+            self.stage_totals = {}
+
+
+class StageTimer:
+    """
+    times consecutive stages; each lap records time since previous lap, or since timer creation
+    """
+
+    def __init__(self, instrumentation):
+        """
+        :param instrumentation: Instrumentation to record stages in
+        """
+        self.instrumentation = instrumentation
+        self.last = time.perf_counter() if instrumentation.enabled else None
+
+    def lap(self, stage, rows=None):
+        """
+        :param stage: name of stage that just ended
+        :param rows: defaults to None; rows processed in stage
+        """
+        if not self.instrumentation.enabled:
+            return
+
+        now = time.perf_counter()
+        self.instrumentation.record(stage, now - self.last, rows)
+        self.last = now
+
+
+# default of instrumented code; records nothing
+NO_INSTRUMENTATION = Instrumentation(enabled=False)
@@ -1,14 +1,213 @@
 from google.cloud import bigquery
+from instrumentation import NO_INSTRUMENTATION
 
+import hashlib
+import numpy as np
+import os
 import polars as pl
+import pyarrow.parquet as pq
+import re
+import time
+
+
+class QueryCache:
+    """
+    on-disk cache of query results as Parquet files, content-addressed by CDR and normalized query text
+    """
+
+    def __init__(self, cache_dir, ttl=7 * 24 * 3600, max_bytes=10 * 1024 ** 3):
+        """
+        :param cache_dir: directory to store cached results in
+        :param ttl: defaults to 7 days; seconds before a cached result expires, None to never expire
+        :param max_bytes: defaults to 10 GiB; least recently used results are evicted above this size,
+                          and single results above it are not cached
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def normalize_query(query):
+        """
+        :param query: query text
+        :return: query text with whitespace collapsed outside quoted literals and without trailing semicolon
+        """
+        # split on quoted strings and identifiers, which are every other part; their whitespace is kept
+        parts = re.split(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`(?:[^`\\]|\\.)*`)""", query)
+        query = "".join(part if i % 2 else re.sub(r"\s+", " ", part) for i, part in enumerate(parts))
+
+        return query.strip().rstrip(";").strip()
+
+    def key(self, query, cdr=None):
+        """
+        :param query: query text
+        :param cdr: defaults to None; CDR dataset the query runs on
+        :return: cache key
+        """
+        return hashlib.sha256(f"{cdr}\n{self.normalize_query(query)}".encode()).hexdigest()
+
+    def path(self, key):
+        """
+        :param key: cache key
+        :return: path of cached result file
+        """
+        return os.path.join(self.cache_dir, f"{key}.parquet")
+
+    def get(self, key):
+        """
+        :param key: cache key
+        :return: cached polars dataframe, None if not cached or expired
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+
+        if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+            os.remove(path)
+            return None
+
+        df = pl.read_parquet(path)
+        # access time tracks recent use for eviction; modified time tracks age for ttl
+        os.utime(path, (time.time(), os.path.getmtime(path)))
+
+        return df
+
+    def get_batches(self, key):
+        """
+        :param key: cache key
+        :return: iterator of cached result as Arrow record batches, None if not cached or expired
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+
+        if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+            os.remove(path)
+            return None
+
+        batches = pq.ParquetFile(path).iter_batches()
+        os.utime(path, (time.time(), os.path.getmtime(path)))
+
+        return batches
+
+    def put(self, key, df):
+        """
+        results larger than max_bytes on their own are not cached, and any older entry of key is removed
+        :param key: cache key
+        :param df: polars dataframe to cache
+        """
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        df.write_parquet(tmp_path)
+        self.commit(tmp_path, path)
+
+    def commit(self, tmp_path, path):
+        """
+        move a fully written result file into place, then evict; see put for oversized results
+        :param tmp_path: path result was written to
+        :param path: path of cached result file
+        """
+        if self.max_bytes is not None and os.path.getsize(tmp_path) > self.max_bytes:
+            os.remove(tmp_path)
+            if os.path.exists(path):
+                os.remove(path)
+            return
+
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def put_batches(self, key, batches):
+        """
+        write Arrow record batches to cache one at a time while passing them on;
+        result is only cached once all batches are consumed, and not if larger than max_bytes
+        :param key: cache key
+        :param batches: iterable of Arrow record batches
+        :return: iterator of same batches
+        """
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        writer = None
+        try:
+            for batch in batches:
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_path, batch.schema)
+                writer.write_batch(batch)
+                yield batch
+            if writer is not None:
+                writer.close()
+                writer = None
+                self.commit(tmp_path, path)
+        finally:
+            # partially consumed or failed downloads are not cached
+            if writer is not None:
+                writer.close()
+                os.remove(tmp_path)
+
+    def evict(self):
+        """
+        remove least recently used results until cache fits in max_bytes
+        """
+        if self.max_bytes is None:
+            return
+
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith(".parquet"):
+                stat = os.stat(os.path.join(self.cache_dir, file_name))
+                entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, file_name))
+
+        total_bytes = sum(entry[1] for entry in entries)
+        for _, size, file_name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, file_name))
+            total_bytes -= size
+
+    def clear(self):
+        """
+        remove all cached results
+        """
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith(".parquet"):
+                os.remove(os.path.join(self.cache_dir, file_name))
 
 
 class SocioEconomicStatus:
 
-    def __init__(self, cdr, question_id_dict=None):
+    # BigQuery client shared by instances without their own client, created on first query
+    shared_client = None
+
+    def __init__(self, cdr, question_id_dict=None, cache_dir=None, cache_ttl=7 * 24 * 3600,
+                 cache_max_bytes=10 * 1024 ** 3, refresh_cache=False, client=None, bqstorage_client=None,
+                 instrumentation=None):
+        """
+        :param cdr: CDR dataset of interest
+        :param question_id_dict: defaults to None; dict of survey question name to question concept id
+        :param cache_dir: defaults to None, i.e., no cache; directory to cache BigQuery results in
+        :param cache_ttl: defaults to 7 days; seconds before a cached result expires, None to never expire
+        :param cache_max_bytes: defaults to 10 GiB; least recently used results are evicted above this size,
+                                and single results above it are not cached
+        :param refresh_cache: defaults to False; if True, queries bypass cached results and overwrite them
+        :param client: defaults to None, i.e., shared client; BigQuery client to run queries with
+        :param bqstorage_client: defaults to None; BigQuery Storage read client streamed results are downloaded with,
+                                 in parallel streams; without it, streamed results are paged through the REST API
+        :param instrumentation: defaults to None, i.e., no instrumentation; Instrumentation to record stage timings in
+        """
         self.cdr = cdr
 
-        self.aou_ses = self.polar_gbq(f"SELECT * FROM {self.cdr}.ds_zip_code_socioeconomic")
+        self.cache = None
+        if cache_dir:
+            self.cache = QueryCache(cache_dir, ttl=cache_ttl, max_bytes=cache_max_bytes)
+        self.refresh_cache = refresh_cache
+        self.client = client
+        self.bqstorage_client = bqstorage_client
+        self.instrumentation = instrumentation
+        if self.instrumentation is None:
+            self.instrumentation = NO_INSTRUMENTATION
+
+        # zip code SES data is only queried on first access of aou_ses
+        self._aou_ses = None
 
         if not question_id_dict:
             self.question_id_dict = {"own_or_rent": 1585370,
@@ -25,6 +224,16 @@ class SocioEconomicStatus:
                             "Annual Income: 100k 150k": 7,
                             "Annual Income: 150k 200k": 8,
                             "Annual Income: more 200k": 9}
+        # area median income ranges of income brackets 1 to 9
+        self.median_income_ranges = [(0.00, 9999.99),
+                                     (10000.00, 24999.99),
+                                     (25000.00, 34999.99),
+                                     (35000.00, 49999.99),
+                                     (50000.00, 74999.99),
+                                     (75000.00, 99999.99),
+                                     (100000.00, 149999.99),
+                                     (150000.00, 199999.99),
+                                     (200000.00, 999999.99)]
         self.edu_dict = {"Highest Grade: Never Attended": 1,
                          "Highest Grade: One Through Four": 2,
                          "Highest Grade: Five Through Eight": 3,
@@ -48,33 +257,169 @@ class SocioEconomicStatus:
                              "Smoke Frequency: Some Days": "smoking_some_days"}
         # "Not At All" are those with zero in all other categories
 
+    @property
+    def aou_ses(self):
+        """
+        :return: polars dataframe of participant zip code median income, queried on first access
+        """
+        if self._aou_ses is None:
+            ses_query = f"SELECT PERSON_ID, MEDIAN_INCOME FROM {self.cdr}.ds_zip_code_socioeconomic"
+            self._aou_ses = self.polar_gbq(ses_query, cache=self.cache, cdr=self.cdr, refresh=self.refresh_cache,
+                                           client=self.client, instrumentation=self.instrumentation)
+
+        return self._aou_ses
+
+    @classmethod
+    def get_shared_client(cls):
+        """
+        :return: BigQuery client shared across queries, created on first call
+        """
+        if cls.shared_client is None:
+            cls.shared_client = bigquery.Client()
+
+        return cls.shared_client
+
     @staticmethod
-    def polar_gbq(query):
+    def polar_gbq(query, cache=None, cdr=None, refresh=False, client=None, instrumentation=None):
         """
         :param query: BigQuery query
+        :param cache: defaults to None; QueryCache to look up and store result in
+        :param cdr: defaults to None; CDR dataset the query runs on, part of cache key
+        :param refresh: defaults to False; if True, cached result is ignored and overwritten
+        :param client: defaults to None, i.e., shared client; BigQuery client to run query with
+        :param instrumentation: defaults to None, i.e., no instrumentation; Instrumentation to record stage timings in
         :return: polars dataframe
         """
-        client = bigquery.Client()
-        query_job = client.query(query)
-        rows = query_job.result()
-        df = pl.from_arrow(rows.to_arrow())
+        if instrumentation is None:
+            instrumentation = NO_INSTRUMENTATION
+
+        if cache is not None:
+            cache_key = cache.key(query, cdr)
+            if not refresh:
+                with instrumentation.stage("cache read") as stage:
+                    df = cache.get(cache_key)
+                    stage["rows"] = len(df) if df is not None else 0
+                if df is not None:
+                    return df
+
+        if client is None:
+            client = SocioEconomicStatus.get_shared_client()
+        with instrumentation.stage("bigquery query"):
+            query_job = client.query(query)
+            rows = query_job.result()
+        with instrumentation.stage("arrow transfer") as stage:
+            df = pl.from_arrow(rows.to_arrow())
+            stage["rows"] = len(df)
+
+        if cache is not None:
+            with instrumentation.stage("cache write", rows=len(df)):
+                cache.put(cache_key, df)
 
         return df
 
+    @staticmethod
+    def polar_gbq_batches(query, cache=None, cdr=None, refresh=False, client=None, bqstorage_client=None,
+                          instrumentation=None):
+        """
+        streaming equivalent of polar_gbq; result is downloaded and cached one Arrow record batch at a time,
+        so it is never held in memory as a whole
+        :param query: BigQuery query
+        :param cache: defaults to None; QueryCache to look up and store result in
+        :param cdr: defaults to None; CDR dataset the query runs on, part of cache key
+        :param refresh: defaults to False; if True, cached result is ignored and overwritten
+        :param client: defaults to None, i.e., shared client; BigQuery client to run query with
+        :param bqstorage_client: defaults to None; BigQuery Storage read client to download result with
+        :param instrumentation: defaults to None, i.e., no instrumentation; Instrumentation to record stage timings in
+        :return: iterator of polars dataframes, one per record batch
+        """
+        if instrumentation is None:
+            instrumentation = NO_INSTRUMENTATION
+
+        if cache is not None:
+            cache_key = cache.key(query, cdr)
+            if not refresh:
+                batches = cache.get_batches(cache_key)
+                if batches is not None:
+                    for batch in batches:
+                        yield pl.from_arrow(batch)
+                    return
+
+        if client is None:
+            client = SocioEconomicStatus.get_shared_client()
+        with instrumentation.stage("bigquery query"):
+            query_job = client.query(query)
+            rows = query_job.result()
+
+        def download():
+            batch_iterator = iter(rows.to_arrow_iterable(bqstorage_client=bqstorage_client))
+            while True:
+                with instrumentation.stage("arrow batch transfer") as stage:
+                    batch = next(batch_iterator, None)
+                    stage["rows"] = batch.num_rows if batch is not None else 0
+                if batch is None:
+                    return
+                yield batch
+
+        batches = download()
+        if cache is not None:
+            batches = cache.put_batches(cache_key, batches)
+        for batch in batches:
+            yield pl.from_arrow(batch)
+
     @staticmethod
     def dummy_coding(data, col_name, lookup_dict):
         """
-        create dummy variables for a categorical variable
+        create dummy variables for a categorical variable, all in one pass
         :param data: polars dataframe
         :param col_name: variable of interest
         :param lookup_dict: dict to map dummy variables
-        :return: polars dataframe with new dummy columns
+        :return: polars dataframe with new UInt8 dummy columns
         """
-        for k, v in lookup_dict.items():
-            data = data.with_columns(pl.when(pl.col(col_name) == k)
-                                     .then(1)
-                                     .otherwise(0)
-                                     .alias(v))
+        data = data.with_columns([(pl.col(col_name) == k).fill_null(False).cast(pl.UInt8).alias(v)
+                                  for k, v in lookup_dict.items()])
+
+        return data
+
+    @staticmethod
+    def ordinal_coding(data, col_name, lookup_dict, alias):
+        """
+        code an ordinal variable through an enum dtype of its categories
+        :param data: polars dataframe
+        :param col_name: variable of interest
+        :param lookup_dict: dict to map categories to consecutive integer codes
+        :param alias: name of new code column
+        :return: polars dataframe with new Int8 code column; null for categories not in lookup_dict
+        """
+        categories = sorted(lookup_dict, key=lookup_dict.get)
+        first_code = lookup_dict[categories[0]]
+        if [lookup_dict[k] for k in categories] != list(range(first_code, first_code + len(categories))):
+            raise ValueError("lookup_dict values must be consecutive integers")
+
+        data = data.with_columns((pl.col(col_name).cast(pl.Enum(categories), strict=False).to_physical()
+                                  .cast(pl.Int8) + first_code)
+                                 .alias(alias))
+
+        return data
+
+    @staticmethod
+    def bracket_coding(data, col_name, bracket_ranges, alias):
+        """
+        code a numeric variable into brackets by binary search of sorted bracket lower bounds
+        :param data: polars dataframe
+        :param col_name: variable of interest
+        :param bracket_ranges: sorted list of (lower bound, upper bound) of brackets 1, 2, ...; both bounds inclusive
+        :param alias: name of new bracket column
+        :return: polars dataframe with new Int8 bracket column; null for values outside all brackets
+        """
+        lower_bounds = np.array([low for low, _ in bracket_ranges])
+        upper_bounds = np.array([high for _, high in bracket_ranges])
+
+        values = data[col_name].cast(pl.Float64).to_numpy()
+        brackets = np.searchsorted(lower_bounds, values, side="right")
+        in_bracket = (brackets > 0) & (values <= upper_bounds[np.maximum(brackets - 1, 0)])
+
+        data = data.with_columns(pl.Series(alias, brackets, dtype=pl.Int8)
+                                 .set(pl.Series(~in_bracket), None))
 
         return data
 
@@ -87,42 +432,18 @@ class SocioEconomicStatus:
         ses_data = self.aou_ses[["PERSON_ID", "MEDIAN_INCOME"]]
 
         # mapping median income to income brackets
-        ses_data = ses_data.with_columns(pl.when((pl.col("MEDIAN_INCOME") >= 0.00) &
-                                                 (pl.col("MEDIAN_INCOME") <= 9999.99))
-                                         .then(1)
-                                         .when((pl.col("MEDIAN_INCOME") >= 10000.00) &
-                                               (pl.col("MEDIAN_INCOME") <= 24999.99))
-                                         .then(2)
-                                         .when((pl.col("MEDIAN_INCOME") >= 25000.00) &
-                                               (pl.col("MEDIAN_INCOME") <= 34999.99))
-                                         .then(3)
-                                         .when((pl.col("MEDIAN_INCOME") >= 35000.00) &
-                                               (pl.col("MEDIAN_INCOME") <= 49999.99))
-                                         .then(4)
-                                         .when((pl.col("MEDIAN_INCOME") >= 50000.00) &
-                                               (pl.col("MEDIAN_INCOME") <= 74999.99))
-                                         .then(5)
-                                         .when((pl.col("MEDIAN_INCOME") >= 75000.00) &
-                                               (pl.col("MEDIAN_INCOME") <= 99999.99))
-                                         .then(6)
-                                         .when((pl.col("MEDIAN_INCOME") >= 100000.00) &
-                                               (pl.col("MEDIAN_INCOME") <= 149999.99))
-                                         .then(7)
-                                         .when((pl.col("MEDIAN_INCOME") >= 150000.00) &
-                                               (pl.col("MEDIAN_INCOME") <= 199999.99))
-                                         .then(8)
-                                         .when((pl.col("MEDIAN_INCOME") >= 200000.00) &
-                                               (pl.col("MEDIAN_INCOME") <= 999999.99))
-                                         .then(9)
-                                         .alias("MEDIAN_INCOME_BRACKET"))
+        timer = self.instrumentation.timer()
+        ses_data = self.bracket_coding(ses_data, "MEDIAN_INCOME", self.median_income_ranges, "MEDIAN_INCOME_BRACKET")
         ses_data = ses_data.rename({"PERSON_ID": "person_id",
                                     "MEDIAN_INCOME": "median_income",
                                     "MEDIAN_INCOME_BRACKET": "median_income_bracket"})
+        timer.lap("coding", rows=len(ses_data))
 
         # compare income and generate
         data = data.join(ses_data, how="inner", on="person_id")
         data = data.with_columns((pl.col("income_bracket") - pl.col("median_income_bracket"))
                                  .alias("compare_to_median_income"))
+        timer.lap("joins", rows=len(data))
         # data = data.drop("median_income_bracket")
 
         return data
@@ -133,22 +454,160 @@ class SocioEconomicStatus:
         
         return df
 
-    def parse_survey_data(self, smoking=False):
+    def add_smoking_question(self):
+        """
+        add smoking frequency question to questions of interest
+        """
+        self.question_id_dict["smoking_frequency"] = 1585860
+
+    def coded_survey_query(self, smoking=False):
+        """
+        build one query that filters, codes and merges survey answers server side, as parse_survey_data does locally
+        :param smoking: defaults to False; if true, data on smoking frequency is added
+        :return: BigQuery query
+        """
+        if smoking:
+            self.add_smoking_question()
+        question_ids = tuple(self.question_id_dict.values())
+
+        def bracket_sql(lookup_dict):
+            return "CASE answer " + " ".join(f"WHEN '{k}' THEN {v}" for k, v in lookup_dict.items()) + " END"
+
+        def dummy_sql(lookup_dict):
+            return ", ".join(f"IF(answer = '{k}', 1, 0) AS {v}" for k, v in lookup_dict.items())
+
+        median_income_bracket_sql = "CASE " + " ".join(f"WHEN MEDIAN_INCOME BETWEEN {low:.2f} AND {high:.2f} THEN {i}"
+                                                       for i, (low, high) in enumerate(self.median_income_ranges, 1))
+        median_income_bracket_sql += " END"
+
+        def question_sql(question_name):
+            return (f"FROM answered "
+                    f"WHERE question_concept_id = {self.question_id_dict[question_name]}")
+
+        query = f"""
+            WITH survey AS (
+                SELECT person_id, question_concept_id, answer
+                FROM {self.cdr}.ds_survey
+                WHERE question_concept_id IN {question_ids}
+            ),
+            answered AS (
+                SELECT * FROM survey
+                WHERE person_id NOT IN (SELECT person_id FROM survey WHERE answer LIKE '%PMI%')
+            ),
+            income AS (
+                SELECT person_id, answer AS income_answer, {bracket_sql(self.income_dict)} AS income_bracket
+                {question_sql("annual_household_income")}
+            ),
+            ses AS (
+                SELECT PERSON_ID AS person_id, MEDIAN_INCOME AS median_income,
+                    {median_income_bracket_sql} AS median_income_bracket
+                FROM {self.cdr}.ds_zip_code_socioeconomic
+            ),
+            education AS (
+                SELECT person_id, answer AS education_answer, {bracket_sql(self.edu_dict)} AS education_bracket
+                {question_sql("education")}
+            ),
+            home AS (
+                SELECT person_id, answer AS home_answer, {dummy_sql(self.home_dict)}
+                {question_sql("own_or_rent")}
+            ),
+            employment AS (
+                SELECT person_id, answer AS employment_answer, {dummy_sql(self.employment_dict)}
+                {question_sql("employment_status")}
+            )"""
+        if smoking:
+            query += f""",
+            smoking AS (
+                SELECT person_id, answer AS smoking_answer, {dummy_sql(self.smoking_dict)}
+                {question_sql("smoking_frequency")}
+            )"""
+        query += """
+            SELECT *, income_bracket - median_income_bracket AS compare_to_median_income
+            FROM income
+            JOIN ses USING (person_id)
+            JOIN education USING (person_id)
+            JOIN home USING (person_id)
+            JOIN employment USING (person_id)"""
+        if smoking:
+            query += """
+            JOIN smoking USING (person_id)"""
+
+        return query
+
+    def parse_survey_data(self, smoking=False, server_side=False, streaming=False):
         """
         get survey data of certain questions
         :param smoking: defaults to False; if true, data on smoking frequency is added
+        :param server_side: defaults to False; if true, answers are filtered, coded and merged in BigQuery
+                            with coded_survey_query, and only the result is downloaded
+        :param streaming: defaults to False; if true and not server_side, survey answers are downloaded
+                          and filtered one record batch at a time; see parse_survey_data_locally
+        :return: polars dataframe with coded answers
+        """
+        if server_side:
+            data = self.polar_gbq(self.coded_survey_query(smoking), cache=self.cache, cdr=self.cdr,
+                                  refresh=self.refresh_cache, client=self.client,
+                                  instrumentation=self.instrumentation)
+            # match column order and dtypes of locally coded data
+            dummy_cols = list(self.home_dict.values()) + list(self.employment_dict.values())
+            if smoking:
+                dummy_cols += list(self.smoking_dict.values())
+            data = data.with_columns(pl.col(["income_bracket", "median_income_bracket", "compare_to_median_income",
+                                             "education_bracket"]).cast(pl.Int8),
+                                     pl.col(dummy_cols).cast(pl.UInt8))
+            data = data.select(["person_id", "income_answer", "income_bracket", "median_income",
+                                "median_income_bracket", "compare_to_median_income",
+                                "education_answer", "education_bracket",
+                                "home_answer", *self.home_dict.values(),
+                                "employment_answer", *self.employment_dict.values()] +
+                               (["smoking_answer", *self.smoking_dict.values()] if smoking else []))
+        else:
+            data = self.parse_survey_data_locally(smoking, streaming=streaming)
+
+        timer = self.instrumentation.timer()
+        data = self.split_string(df=data, col="income_answer", split_by=": ", item_index=1)
+        data = self.split_string(df=data, col="education_answer", split_by=": ", item_index=1)
+        data = self.split_string(df=data, col="home_answer", split_by=": ", item_index=1)
+        data = self.split_string(df=data, col="employment_answer", split_by=": ", item_index=1)
+
+        data = data.rename(
+            {
+                "income_answer": "annual income",
+                "education_answer": "highest degree",
+                "home_answer": "homeownership",
+                "employment_answer": "employment status"
+            }
+        )
+        timer.lap("answer formatting", rows=len(data))
+
+        return data
+
+    def parse_survey_data_locally(self, smoking=False, streaming=False):
+        """
+        download survey answers of certain questions, then filter, code and merge them locally
+        :param smoking: defaults to False; if true, data on smoking frequency is added
+        :param streaming: defaults to False; if true, answers are downloaded one record batch at a time with
+                          polar_gbq_batches, and each batch is reduced to answered questions before the next,
+                          bounding peak memory to the reduced answers plus one batch
         :return: polars dataframe with coded answers
         """
         if smoking:
-            self.question_id_dict["smoking_frequency"] = 1585860
+            self.add_smoking_question()
         question_ids = tuple(self.question_id_dict.values())
 
         survey_query = f"SELECT * FROM {self.cdr}.ds_survey WHERE question_concept_id IN {question_ids}"
-        survey_data = self.polar_gbq(survey_query)
+        if streaming:
+            survey_data, no_answer_ids = self.stream_survey_answers(survey_query)
+            timer = self.instrumentation.timer()
+        else:
+            survey_data = self.polar_gbq(survey_query, cache=self.cache, cdr=self.cdr, refresh=self.refresh_cache,
+                                         client=self.client, instrumentation=self.instrumentation)
+            timer = self.instrumentation.timer()
+            no_answer_ids = survey_data.filter(pl.col("answer").str.contains("PMI"))["person_id"].unique()
 
         # filter out people without survey answer, e.g., skip, don't know, prefer not to answer
-        no_answer_ids = survey_data.filter(pl.col("answer").str.contains("PMI"))["person_id"].unique().to_list()
         survey_data = survey_data.filter(~pl.col("person_id").is_in(no_answer_ids))
+        timer.lap("no answer filter", rows=len(survey_data))
 
         # split survey data into separate data by question
         question_list = survey_data["question"].unique().to_list()
@@ -158,19 +617,27 @@ class SocioEconomicStatus:
             survey_dict[key_name] = survey_data.filter(pl.col("question") == question)
             survey_dict[key_name] = survey_dict[key_name][["person_id", "answer"]]
             survey_dict[key_name] = survey_dict[key_name].rename({"answer": f"{key_name.lower()}_answer"})
+        # questions nobody answered, e.g., in an empty result, are coded as empty data
+        for key_name in ["Income", "Education", "Home", "Employment"] + (["Smoking"] if smoking else []):
+            if key_name not in survey_dict:
+                survey_dict[key_name] = pl.DataFrame(schema={"person_id": survey_data["person_id"].dtype,
+                                                             f"{key_name.lower()}_answer": pl.Utf8})
+        timer.lap("question split", rows=len(survey_data))
 
         # code income data
-        survey_dict["Income"] = survey_dict["Income"].with_columns(pl.col("income_answer").alias("income_bracket"))
-        survey_dict["Income"] = survey_dict["Income"].with_columns(pl.col("income_bracket")
-                                                                   .replace(self.income_dict, default=pl.first())
-                                                                   .cast(pl.Int64))
+        survey_dict["Income"] = self.ordinal_coding(data=survey_dict["Income"],
+                                                    col_name="income_answer",
+                                                    lookup_dict=self.income_dict,
+                                                    alias="income_bracket")
+        timer.lap("coding", rows=len(survey_dict["Income"]))
         survey_dict["Income"] = self.compare_with_median_income(survey_dict["Income"])
+        timer = self.instrumentation.timer()
 
         # code education data
-        survey_dict["Education"] = survey_dict["Education"].with_columns(pl.col("education_answer").alias("education_bracket"))
-        survey_dict["Education"] = survey_dict["Education"].with_columns(pl.col("education_bracket")
-                                                                         .replace(self.edu_dict, default=pl.first())
-                                                                         .cast(pl.Int64))
+        survey_dict["Education"] = self.ordinal_coding(data=survey_dict["Education"],
+                                                       col_name="education_answer",
+                                                       lookup_dict=self.edu_dict,
+                                                       alias="education_bracket")
 
         # code home own data
         survey_dict["Home"] = self.dummy_coding(data=survey_dict["Home"],
@@ -185,28 +652,46 @@ class SocioEconomicStatus:
         # code smoking data
         if smoking:
             survey_dict["Smoking"] = self.dummy_coding(data=survey_dict["Smoking"],
-                                                       col_name="smoking_status",
+                                                       col_name="smoking_answer",
                                                        lookup_dict=self.smoking_dict)
 
+        timer.lap("coding", rows=sum(len(survey_dict[k]) for k in survey_dict if k != "Income"))
+
         # merge data
         data = survey_dict["Income"].join(survey_dict["Education"], how="inner", on="person_id")
         data = data.join(survey_dict["Home"], how="inner", on="person_id")
         data = data.join(survey_dict["Employment"], how="inner", on="person_id")
         if smoking:
             data = data.join(survey_dict["Smoking"], how="inner", on="person_id")
+        timer.lap("joins", rows=len(data))
 
-        data = self.split_string(df=data, col="income_answer", split_by=": ", item_index=1)
-        data = self.split_string(df=data, col="education_answer", split_by=": ", item_index=1)
-        data = self.split_string(df=data, col="home_answer", split_by=": ", item_index=1)
-        data = self.split_string(df=data, col="employment_answer", split_by=": ", item_index=1)
-
-        data = data.rename(
-            {
-                "income_answer": "annual income",
-                "education_answer": "highest degree",
-                "home_answer": "homeownership",
-                "employment_answer": "employment status"
-            }
-        )
-        
         return data
+
+    def stream_survey_answers(self, survey_query):
+        """
+        :param survey_query: ds_survey query
+        :return: polars dataframe of person_id, question and answer of answered questions,
+                 and polars series of person_id with any unanswered question
+        """
+        answer_dfs = []
+        no_answer_dfs = []
+        for batch in self.polar_gbq_batches(survey_query, cache=self.cache, cdr=self.cdr,
+                                            refresh=self.refresh_cache, client=self.client,
+                                            bqstorage_client=self.bqstorage_client,
+                                            instrumentation=self.instrumentation):
+            with self.instrumentation.stage("batch no answer filter", rows=len(batch)):
+                batch = batch.select(["person_id", "question", "answer"])
+                no_answer = pl.col("answer").str.contains("PMI")
+                no_answer_dfs.append(batch.filter(no_answer).select("person_id").unique())
+                answer_dfs.append(batch.filter(~no_answer))
+
+        # a result without batches has no schema to take columns from
+        if not answer_dfs:
+            survey_data = pl.DataFrame(schema={"person_id": pl.Int64, "question": pl.Utf8, "answer": pl.Utf8})
+            return survey_data, survey_data["person_id"]
+
+        with self.instrumentation.stage("batch concat", rows=sum(len(df) for df in answer_dfs)):
+            survey_data = pl.concat(answer_dfs)
+            no_answer_ids = pl.concat(no_answer_dfs)["person_id"].unique()
+
+        return survey_data, no_answer_ids
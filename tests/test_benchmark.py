@@ -0,0 +1,19 @@
+from benchmark import FakeBigQueryClient, SURVEY_QUESTIONS, run_benchmarks, synthetic_survey_data
+
+
+def test_fake_client_applies_question_filter():
+    client = FakeBigQueryClient({"ds_survey": synthetic_survey_data(100)})
+
+    rows = client.query("SELECT * FROM cdr.ds_survey WHERE question_concept_id IN (1585370, 1585940)").result()
+
+    assert set(rows.to_arrow()["question_concept_id"].to_pylist()) == {1585370, 1585940}
+    all_rows = client.query("SELECT * FROM cdr.ds_survey").result()
+    assert len(all_rows.to_arrow()) == 100 * len(SURVEY_QUESTIONS)
+
+
+def test_benchmark_records_reference_engine():
+    report = run_benchmarks(sizes=(50,), engines=("columnar", "index"), n_zip3=5, years=2, output_path=None)
+
+    profiles = [result for result in report["results"] if result["benchmark"] == "create_epa_param_profile"]
+    assert [result["reference_engine"] for result in profiles] == ["columnar", "columnar"]
+    assert all(result["matches_reference"] for result in profiles)
@@ -0,0 +1,55 @@
+from benchmark import synthetic_epa_data, synthetic_participant_dx_period
+from epatools import Profiling
+from instrumentation import Instrumentation
+
+
+def test_summary_totals_without_kept_events():
+    instrumentation = Instrumentation()
+    instrumentation.record("filter", 0.5, rows=10)
+    instrumentation.record("join", 0.25)
+    instrumentation.record("filter", 0.5, rows=30)
+
+    summary = instrumentation.summary().rows(named=True)
+
+    assert instrumentation.events == []
+    assert [row["stage"] for row in summary] == ["filter", "join"]
+    assert (summary[0]["calls"], summary[0]["seconds"], summary[0]["rows"]) == (2, 1.0, 40)
+    assert summary[0]["rows_per_second"] == 40.0
+    assert (summary[1]["calls"], summary[1]["rows"]) == (1, 0)
+
+
+def test_keep_events_and_callback():
+    callback_events = []
+    instrumentation = Instrumentation(callback=callback_events.append, keep_events=True)
+    with instrumentation.stage("filter") as stage:
+        stage["rows"] = 5
+
+    assert len(instrumentation.events) == 1
+    assert callback_events == instrumentation.events
+    assert callback_events[0]["rows"] == 5
+
+    instrumentation.reset()
+    assert instrumentation.events == []
+    assert len(instrumentation.summary()) == 0
+
+
+def test_disabled_instrumentation_records_nothing():
+    instrumentation = Instrumentation(enabled=False, keep_events=True)
+    with instrumentation.stage("filter"):
+        pass
+    instrumentation.timer().lap("join")
+
+    assert instrumentation.events == []
+    assert len(instrumentation.summary()) == 0
+
+
+def test_rows_engine_stages():
+    instrumentation = Instrumentation()
+    participant_dx_period = synthetic_participant_dx_period(20, n_zip3=5, years=2)
+    epa_data = synthetic_epa_data(n_zip3=5, years=2)
+
+    Profiling(instrumentation).create_epa_param_profile(participant_dx_period, epa_data, "ozone", backend="serial")
+
+    stages = set(instrumentation.summary()["stage"])
+    assert {"epa zip3 filter", "epa date filter", "result assembly", "final join"} <= stages
+    assert instrumentation.events == []
@@ -0,0 +1,236 @@
+from collections import OrderedDict
+from benchmark import synthetic_epa_data, synthetic_participant_dx_period
+from epatools import Profiling, ProfileStore
+from polars.testing import assert_frame_equal
+
+import datetime
+import numpy as np
+import polars as pl
+import pytest
+import weakref
+
+
+@pytest.fixture(scope="module")
+def epa_data():
+    epa_data = synthetic_epa_data(n_zip3=5, years=2, null_aqi_day_rate=0.05)
+    # single null readings next to valid ones, and a zip3 with no valid AQI at all
+    rng = np.random.default_rng(4)
+    null_readings = pl.Series(rng.random(len(epa_data)) < 0.05)
+    epa_data = epa_data.with_columns(epa_data["aqi"].set(null_readings, None))
+    no_aqi = (epa_data.filter(pl.col("zip3") == "100")
+              .with_columns(pl.lit("199").alias("zip3"), pl.lit(None, dtype=pl.Float64).alias("aqi")))
+    return pl.concat([epa_data, no_aqi])
+
+
+@pytest.fixture(scope="module")
+def participant_dx_period():
+    participant_dx_period = synthetic_participant_dx_period(150, n_zip3=5, years=2)
+    return pl.concat([participant_dx_period,
+                      # a window in the zip3 without AQI, and windows before and after all EPA data
+                      pl.DataFrame({"person_id": ["no_aqi", "before_data", "after_data"],
+                                    "zip3": ["199", "100", "100"],
+                                    "start_date": [datetime.date(2011, 3, 1), datetime.date(1990, 1, 1),
+                                                   datetime.date(2015, 1, 1)],
+                                    "end_date": [datetime.date(2011, 6, 1), datetime.date(1991, 1, 1),
+                                                 datetime.date(2015, 6, 1)]})])
+
+
+@pytest.fixture(scope="module", params=["ozone", "aqi"])
+def param_name(request):
+    return request.param
+
+
+@pytest.fixture(scope="module")
+def rows_profile(participant_dx_period, epa_data, param_name):
+    return Profiling().create_epa_param_profile(participant_dx_period, epa_data, param_name, backend="serial")
+
+
+def test_null_aqi_days_are_left_out_of_means_and_bins(rows_profile, param_name):
+    measured = rows_profile.filter(pl.col(f"{param_name}_total_measured_days").is_not_nan())
+    binned_days = sum(measured[f"{param_name}_aqi_{aqi_bin}_days"]
+                      for aqi_bin in ["0to25", "26to50", "51to75", "76to100", "101to150", "151plus"])
+
+    assert (binned_days < measured[f"{param_name}_total_measured_days"]).any()
+    no_aqi = rows_profile.filter(pl.col("person_id") == "no_aqi").row(0, named=True)
+    assert np.isnan(no_aqi[f"{param_name}_mean_aqi"])
+    assert no_aqi[f"{param_name}_total_measured_days"] > 0
+    others = rows_profile.filter(pl.col("person_id") != "no_aqi")
+    measured_others = others.filter(pl.col(f"{param_name}_total_measured_days").is_not_nan())
+    assert measured_others[f"{param_name}_mean_aqi"].is_not_nan().all()
+
+
+@pytest.mark.parametrize("engine", ["columnar", "index"])
+def test_engines_match_rows_engine(rows_profile, participant_dx_period, epa_data, param_name, engine):
+    profile = Profiling().create_epa_param_profile(participant_dx_period, epa_data, param_name, engine=engine)
+
+    assert_frame_equal(profile, rows_profile, rtol=1e-9)
+
+
+def test_create_epa_profile_matches_rows_engine(rows_profile, participant_dx_period, epa_data, param_name):
+    profile = Profiling().create_epa_profile(participant_dx_period, {param_name: epa_data})
+
+    assert_frame_equal(profile, rows_profile, rtol=1e-9)
+
+
+def test_profile_store_matches_rows_engine(rows_profile, participant_dx_period, epa_data, param_name):
+    first_half = epa_data.filter(pl.col("date") < datetime.date(2011, 1, 1))
+    store = ProfileStore.create(participant_dx_period, first_half, param_name)
+    store.update_epa_data(epa_data.filter(pl.col("date") >= datetime.date(2011, 1, 1)))
+
+    assert_frame_equal(store.profile(), rows_profile, rtol=1e-9)
+
+
+def test_profile_store_replaces_overlapping_days(participant_dx_period, epa_data):
+    store = ProfileStore.create(participant_dx_period, epa_data, "ozone")
+    overlap = (pl.col("date") >= datetime.date(2010, 11, 1)) & (pl.col("date") < datetime.date(2011, 2, 1))
+
+    # re-delivered days leave profile unchanged
+    store.update_epa_data(epa_data.filter(overlap))
+    expected = Profiling().create_epa_param_profile(participant_dx_period, epa_data, "ozone", engine="index")
+    assert_frame_equal(store.profile(), expected, rtol=1e-9)
+
+    # revised days replace stored ones
+    revised = epa_data.with_columns(pl.when(overlap).then(pl.col("aqi") + 40).otherwise(pl.col("aqi")).alias("aqi"),
+                                    pl.when(overlap).then(pl.col("arithmetic_mean") * 2)
+                                    .otherwise(pl.col("arithmetic_mean")).alias("arithmetic_mean"))
+    n_recomputed = store.update_epa_data(revised.filter(overlap))
+    expected = Profiling().create_epa_param_profile(participant_dx_period, revised, "ozone", engine="index")
+    assert n_recomputed > 0
+    assert_frame_equal(store.profile(), expected, rtol=1e-9)
+
+
+@pytest.fixture(scope="module")
+def unmeasured_dx_period():
+    # zip3s without any monitor in EPA data
+    return synthetic_participant_dx_period(30, n_zip3=5, years=2, unmeasured_zip3_rate=1.0)
+
+
+def test_index_engine_on_unmeasured_cohort(unmeasured_dx_period, epa_data, param_name):
+    expected = Profiling().create_epa_param_profile(unmeasured_dx_period, epa_data, param_name, backend="serial")
+    profile = Profiling().create_epa_param_profile(unmeasured_dx_period, epa_data, param_name, engine="index")
+
+    assert expected[f"{param_name}_total_measured_days"].is_nan().all()
+    assert_frame_equal(profile, expected)
+
+
+def test_create_epa_profile_with_unmeasured_param(participant_dx_period, epa_data):
+    # pm25 has no monitor in any cohort zip3
+    pm25_data = epa_data.with_columns(pl.lit("000").alias("zip3"))
+    profile = Profiling().create_epa_profile(participant_dx_period, {"ozone": epa_data, "pm25": pm25_data})
+    expected_ozone = Profiling().create_epa_param_profile(participant_dx_period, epa_data, "ozone", engine="index")
+
+    assert_frame_equal(profile.select(expected_ozone.columns), expected_ozone)
+    assert profile["pm25_total_measured_days"].is_nan().all()
+    assert (profile["pm25_first_measured_date"] == datetime.date(1900, 1, 1)).all()
+
+
+def test_index_engine_on_empty_cohort(participant_dx_period, epa_data, param_name):
+    profile = Profiling().create_epa_param_profile(participant_dx_period.clear(), epa_data, param_name, engine="index")
+
+    assert len(profile) == 0
+
+
+@pytest.mark.parametrize("engine", ["rows", "columnar"])
+def test_engines_on_empty_cohort(participant_dx_period, epa_data, param_name, engine):
+    profile = Profiling().create_epa_param_profile(participant_dx_period.clear(), epa_data, param_name,
+                                                   engine=engine, backend="serial")
+
+    schema = Profiling.aqi_schema(param_name)
+    assert profile.select(list(schema.keys())).schema == schema
+    assert len(profile) == 0
+
+
+@pytest.mark.parametrize("engine", ["rows", "columnar", "index"])
+@pytest.mark.parametrize("backend", ["threads", "chunked", "processes"])
+def test_backends_match_serial_backend(rows_profile, participant_dx_period, epa_data, param_name, engine, backend):
+    # small chunks and two workers give several zip3 partitions, whose results are put back in row order
+    profile = Profiling().create_epa_param_profile(participant_dx_period, epa_data, param_name, engine=engine,
+                                                   backend=backend, n_workers=2, chunk_size=40, dedupe=False)
+
+    assert_frame_equal(profile, rows_profile, rtol=1e-9)
+
+
+def test_partition_by_zip3(participant_dx_period):
+    partitions = Profiling.partition_by_zip3(participant_dx_period, 3)
+    zip3s = [set(participant_dx_period[rows]["zip3"]) for rows in partitions]
+
+    assert len(partitions) == 3
+    assert np.array_equal(np.sort(np.concatenate(partitions)), np.arange(len(participant_dx_period)))
+    assert sum(len(z) for z in zip3s) == len(set().union(*zip3s))
+
+
+@pytest.mark.parametrize("backend", ["chunked", "processes"])
+def test_partition_backends_on_empty_cohort(participant_dx_period, epa_data, backend):
+    profile = Profiling().profile_param_partitions(participant_dx_period.clear(), epa_data, "ozone",
+                                                   backend=backend)
+
+    assert profile.schema == Profiling.aqi_schema("ozone")
+    assert len(profile) == 0
+
+
+@pytest.mark.parametrize("engine", ["rows", "columnar", "index"])
+def test_dedupe_matches_undeduped_profile(participant_dx_period, epa_data, param_name, engine):
+    # every window twice under other person_ids, plus a row without zip3
+    duplicated = pl.concat([participant_dx_period,
+                            participant_dx_period.reverse().with_columns(pl.col("person_id") + "_copy"),
+                            participant_dx_period.head(2).with_columns(pl.lit(None, pl.Utf8).alias("zip3"),
+                                                                       pl.col("person_id") + "_no_zip3")])
+    expected = Profiling().create_epa_param_profile(duplicated, epa_data, param_name, engine=engine,
+                                                    backend="serial", dedupe=False)
+    profile = Profiling().create_epa_param_profile(duplicated, epa_data, param_name, engine=engine,
+                                                   backend="serial", dedupe=True)
+
+    assert Profiling.dedupe_windows(duplicated)[1] is not None
+    assert_frame_equal(profile, expected)
+
+
+@pytest.fixture()
+def all_time_means_cache(monkeypatch):
+    cache = OrderedDict()
+    monkeypatch.setattr(Profiling, "all_time_means_cache", cache)
+    monkeypatch.setattr(Profiling, "all_time_means_cache_size", 2)
+    return cache
+
+
+def test_all_time_means_cache_is_bounded_lru(all_time_means_cache, epa_data):
+    def all_time_means(zip3):
+        return Profiling.get_all_time_means(epa_data, epa_data.filter(pl.col("zip3") == zip3), "ozone", zip3)
+
+    first = all_time_means("100")
+    all_time_means("101")
+    # touching 100 makes 101 the least recently used entry
+    assert all_time_means("100") == first
+    all_time_means("102")
+
+    assert list(all_time_means_cache) == [(id(epa_data), "ozone", "100"), (id(epa_data), "ozone", "102")]
+
+
+def test_all_time_means_cache_ignores_reused_ids(all_time_means_cache, epa_data):
+    param_by_zip3 = epa_data.filter(pl.col("zip3") == "100")
+    # an entry left by another df that had the same id
+    stale_df = pl.DataFrame()
+    all_time_means_cache[(id(epa_data), "ozone", "100")] = (weakref.ref(stale_df), (0.0, 0.0))
+
+    all_time_means = Profiling.get_all_time_means(epa_data, param_by_zip3, "ozone", "100")
+
+    assert all_time_means == pytest.approx((param_by_zip3["arithmetic_mean"].mean(), param_by_zip3["aqi"].mean()))
+    assert all_time_means_cache[(id(epa_data), "ozone", "100")][0]() is epa_data
+
+
+@pytest.mark.parametrize("source", ["lazy", "epa.parquet", "epa.arrow", "epa.ipc", "epa.feather"])
+@pytest.mark.parametrize("engine", ["rows", "columnar", "index"])
+def test_epa_data_sources_match_eager_df(participant_dx_period, epa_data, engine, source, tmp_path):
+    if source == "lazy":
+        epa_source = epa_data.lazy()
+    else:
+        epa_source = tmp_path / source
+        if source.endswith(".parquet"):
+            epa_data.write_parquet(epa_source)
+        else:
+            epa_data.write_ipc(epa_source)
+    expected = Profiling().create_epa_param_profile(participant_dx_period, epa_data, "ozone", engine=engine,
+                                                    backend="serial")
+    profile = Profiling().create_epa_param_profile(participant_dx_period, epa_source, "ozone", engine=engine,
+                                                   backend="serial")
+
+    assert_frame_equal(profile, expected)
@@ -0,0 +1,161 @@
+from benchmark import FakeBigQueryClient
+from polars.testing import assert_frame_equal
+from survey import QueryCache, SocioEconomicStatus
+
+import os
+import polars as pl
+import pytest
+import time
+
+
+@pytest.fixture
+def table():
+    return pl.DataFrame({"person_id": list(range(100)), "value": [float(i) for i in range(100)]})
+
+
+@pytest.fixture
+def client(table):
+    return FakeBigQueryClient({"results": table, "other_results": table.head(10)})
+
+
+def cached_files(cache_dir):
+    return sorted(os.listdir(cache_dir))
+
+
+def test_cache_hit_skips_query(tmp_path, client, table):
+    cache = QueryCache(str(tmp_path))
+    query = "SELECT * FROM cdr.results"
+
+    first = SocioEconomicStatus.polar_gbq(query, cache=cache, cdr="cdr", client=client)
+    second = SocioEconomicStatus.polar_gbq(query, cache=cache, cdr="cdr", client=client)
+
+    assert len(client.queries) == 1
+    assert_frame_equal(first, table)
+    assert_frame_equal(second, table)
+
+
+def test_key_normalizes_whitespace_and_semicolon(tmp_path, client):
+    cache = QueryCache(str(tmp_path))
+
+    SocioEconomicStatus.polar_gbq("SELECT *\n  FROM cdr.results", cache=cache, cdr="cdr", client=client)
+    SocioEconomicStatus.polar_gbq("SELECT * FROM cdr.results;", cache=cache, cdr="cdr", client=client)
+
+    assert len(client.queries) == 1
+
+
+def test_key_keeps_whitespace_in_quoted_literals(tmp_path):
+    cache = QueryCache(str(tmp_path))
+    query = "SELECT * FROM cdr.results WHERE answer = 'a  b'"
+
+    assert cache.key(query) != cache.key("SELECT * FROM cdr.results WHERE answer = 'a b'")
+    assert cache.key(query) == cache.key("SELECT *\n  FROM cdr.results  WHERE answer = 'a  b';")
+    assert (QueryCache.normalize_query("SELECT  'it\\'s  \"x\"', \"a  'b'\"  FROM  `my  table` ;") ==
+            "SELECT 'it\\'s  \"x\"', \"a  'b'\" FROM `my  table`")
+
+
+def test_cdr_is_part_of_key(tmp_path, client):
+    cache = QueryCache(str(tmp_path))
+    query = "SELECT * FROM cdr.results"
+
+    SocioEconomicStatus.polar_gbq(query, cache=cache, cdr="cdr_v7", client=client)
+    SocioEconomicStatus.polar_gbq(query, cache=cache, cdr="cdr_v8", client=client)
+
+    assert len(client.queries) == 2
+    assert cache.key(query, "cdr_v7") != cache.key(query, "cdr_v8")
+    assert len(cached_files(tmp_path)) == 2
+
+
+def test_expired_entry_is_queried_again(tmp_path, client):
+    cache = QueryCache(str(tmp_path), ttl=60)
+    query = "SELECT * FROM cdr.results"
+
+    SocioEconomicStatus.polar_gbq(query, cache=cache, cdr="cdr", client=client)
+    path = cache.path(cache.key(query, "cdr"))
+    written = time.time() - 120
+    os.utime(path, (written, written))
+
+    assert cache.get(cache.key(query, "cdr")) is None
+    assert not os.path.exists(path)
+    SocioEconomicStatus.polar_gbq(query, cache=cache, cdr="cdr", client=client)
+    assert len(client.queries) == 2
+
+
+def test_refresh_overwrites_entry(tmp_path, client, table):
+    cache = QueryCache(str(tmp_path))
+    query = "SELECT * FROM cdr.results"
+
+    SocioEconomicStatus.polar_gbq(query, cache=cache, cdr="cdr", client=client)
+    client.tables["results"] = table.with_columns(pl.col("value") * 2)
+    refreshed = SocioEconomicStatus.polar_gbq(query, cache=cache, cdr="cdr", client=client, refresh=True)
+    cached = SocioEconomicStatus.polar_gbq(query, cache=cache, cdr="cdr", client=client)
+
+    assert len(client.queries) == 2
+    assert_frame_equal(refreshed, client.tables["results"])
+    assert_frame_equal(cached, client.tables["results"])
+    assert cached_files(tmp_path) == [os.path.basename(cache.path(cache.key(query, "cdr")))]
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path, client, table):
+    table.write_parquet(tmp_path / "size.parquet")
+    entry_bytes = os.path.getsize(tmp_path / "size.parquet")
+    os.remove(tmp_path / "size.parquet")
+    # room for two entries
+    cache = QueryCache(str(tmp_path), max_bytes=int(entry_bytes * 2.5))
+    queries = [f"SELECT * FROM cdr.results WHERE {i} = {i}" for i in range(3)]
+
+    now = time.time()
+    for i, query in enumerate(queries[:2]):
+        SocioEconomicStatus.polar_gbq(query, cache=cache, cdr="cdr", client=client)
+        os.utime(cache.path(cache.key(query, "cdr")), (now - 100 + i, now - 100 + i))
+    # reading first entry makes second entry least recently used
+    SocioEconomicStatus.polar_gbq(queries[0], cache=cache, cdr="cdr", client=client)
+    SocioEconomicStatus.polar_gbq(queries[2], cache=cache, cdr="cdr", client=client)
+
+    assert os.path.exists(cache.path(cache.key(queries[0], "cdr")))
+    assert not os.path.exists(cache.path(cache.key(queries[1], "cdr")))
+    assert os.path.exists(cache.path(cache.key(queries[2], "cdr")))
+
+
+def test_result_larger_than_max_bytes_is_not_cached(tmp_path, client, table):
+    cache = QueryCache(str(tmp_path), max_bytes=10 ** 9)
+    query = "SELECT * FROM cdr.results"
+    SocioEconomicStatus.polar_gbq(query, cache=cache, cdr="cdr", client=client)
+
+    cache.max_bytes = 100
+    df = SocioEconomicStatus.polar_gbq(query, cache=cache, cdr="cdr", client=client, refresh=True)
+
+    assert_frame_equal(df, table)
+    # older entry of same key is removed rather than served stale
+    assert cached_files(tmp_path) == []
+
+
+def test_put_replaces_entry_atomically(tmp_path, table, monkeypatch):
+    cache = QueryCache(str(tmp_path))
+    key = cache.key("SELECT * FROM cdr.results", "cdr")
+    replaced = []
+    original_replace = os.replace
+
+    def replace(src, dst):
+        # result is fully written under a temporary name before it becomes visible
+        assert src.endswith(".tmp") and os.path.getsize(src) > 0
+        assert not os.path.exists(dst)
+        replaced.append((src, dst))
+        original_replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", replace)
+    cache.put(key, table)
+    monkeypatch.undo()
+
+    assert replaced == [(replaced[0][0], cache.path(key))]
+    assert cached_files(tmp_path) == [os.path.basename(cache.path(key))]
+    assert_frame_equal(cache.get(key), table)
+
+
+def test_ses_cache_dir_caches_queries(tmp_path, client):
+    client.tables["ds_zip_code_socioeconomic"] = pl.DataFrame({"PERSON_ID": [1, 2], "MEDIAN_INCOME": [1.0, 2.0]})
+
+    SocioEconomicStatus("cdr", cache_dir=str(tmp_path), client=client).aou_ses
+    SocioEconomicStatus("cdr", cache_dir=str(tmp_path), client=client).aou_ses
+    SocioEconomicStatus("cdr", cache_dir=str(tmp_path), client=client, refresh_cache=True).aou_ses
+
+    assert len(client.queries) == 2
@@ -0,0 +1,49 @@
+from benchmark import FakeBigQueryClient, synthetic_zip_code_ses
+from polars.testing import assert_frame_equal
+from survey import SocioEconomicStatus
+
+import pytest
+import survey
+
+
+@pytest.fixture
+def client():
+    return FakeBigQueryClient({"ds_zip_code_socioeconomic": synthetic_zip_code_ses(100)})
+
+
+def test_aou_ses_is_queried_once_on_first_access(client):
+    ses = SocioEconomicStatus("cdr", client=client)
+    assert client.queries == []
+
+    first = ses.aou_ses
+    second = ses.aou_ses
+
+    assert second is first
+    assert client.queries == ["SELECT PERSON_ID, MEDIAN_INCOME FROM cdr.ds_zip_code_socioeconomic"]
+
+
+def test_aou_ses_is_read_from_cache(client, tmp_path):
+    expected = SocioEconomicStatus("cdr", cache_dir=tmp_path, client=client).aou_ses
+
+    aou_ses = SocioEconomicStatus("cdr", cache_dir=tmp_path, client=client).aou_ses
+
+    assert len(client.queries) == 1
+    assert_frame_equal(aou_ses, expected)
+
+
+def test_instances_without_client_share_one_client(client, monkeypatch):
+    created = []
+
+    def make_client():
+        created.append(client)
+        return client
+
+    monkeypatch.setattr(SocioEconomicStatus, "shared_client", None)
+    monkeypatch.setattr(survey.bigquery, "Client", make_client)
+
+    SocioEconomicStatus("cdr").aou_ses
+    SocioEconomicStatus("cdr").aou_ses
+
+    assert len(created) == 1
+    assert SocioEconomicStatus.get_shared_client() is client
+    assert len(client.queries) == 2
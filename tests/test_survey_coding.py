@@ -0,0 +1,114 @@
+from benchmark import FakeBigQueryClient, synthetic_survey_data, synthetic_zip_code_ses
+from polars.testing import assert_frame_equal, assert_series_equal
+from survey import SocioEconomicStatus
+
+import polars as pl
+import pytest
+
+
+N_PARTICIPANTS = 500
+
+
+@pytest.fixture
+def tables():
+    return {"ds_survey": synthetic_survey_data(N_PARTICIPANTS),
+            "ds_zip_code_socioeconomic": synthetic_zip_code_ses(N_PARTICIPANTS)}
+
+
+class DuckDBClient:
+    """
+    fake BigQuery client running queries on in-memory tables with duckdb
+    """
+
+    def __init__(self, tables):
+        duckdb = pytest.importorskip("duckdb")
+        self.connection = duckdb.connect()
+        self.connection.execute("CREATE SCHEMA cdr")
+        for table_name, table in tables.items():
+            self.connection.register(f"{table_name}_df", table.to_arrow())
+            self.connection.execute(f"CREATE TABLE cdr.{table_name} AS SELECT * FROM {table_name}_df")
+
+    def query(self, query):
+        self.result_table = self.connection.execute(query).arrow()
+        return self
+
+    def result(self):
+        return self
+
+    def to_arrow(self):
+        return self.result_table
+
+
+@pytest.mark.parametrize("smoking", [False, True])
+def test_coded_survey_query_includes_questions(smoking):
+    ses = SocioEconomicStatus("cdr", client=object())
+
+    query = ses.coded_survey_query(smoking=smoking)
+
+    assert ("1585860" in query) == smoking
+    assert ("smoking_answer" in query) == smoking
+    for question_id in (1585370, 1585940, 1585952, 1585375):
+        assert str(question_id) in query
+
+
+@pytest.mark.parametrize("smoking", [False, True])
+def test_server_side_coding_matches_local_coding(tables, smoking):
+    client = DuckDBClient(tables)
+    expected = SocioEconomicStatus("cdr", client=client).parse_survey_data(smoking=smoking)
+    data = SocioEconomicStatus("cdr", client=client).parse_survey_data(smoking=smoking, server_side=True)
+
+    assert len(data) > 0
+    assert_frame_equal(data.sort("person_id"), expected.sort("person_id"))
+
+
+@pytest.mark.parametrize("smoking", [False, True])
+def test_server_side_result_gets_local_column_order_and_dtypes(tables, smoking):
+    expected = SocioEconomicStatus("cdr", client=FakeBigQueryClient(tables)).parse_survey_data(smoking=smoking)
+    # BigQuery returns coded columns as INT64, in its own column order
+    coded = SocioEconomicStatus("cdr", client=FakeBigQueryClient(tables)).parse_survey_data_locally(smoking=smoking)
+    coded = coded.select(reversed(coded.columns)).with_columns(pl.col(pl.Int8, pl.UInt8).cast(pl.Int64))
+    ses = SocioEconomicStatus("cdr", client=FakeBigQueryClient({"ds_survey": coded}))
+
+    data = ses.parse_survey_data(smoking=smoking, server_side=True)
+
+    assert_frame_equal(data, expected)
+
+
+def test_bracket_coding_matches_range_conditions():
+    ses = SocioEconomicStatus("cdr", client=object())
+    median_income = [0.0, 5000.0, 9999.99, 9999.995, 10000.0, 24999.99, 35000.0, 74999.99, 150000.0,
+                     199999.995, 200000.0, 999999.99, 1e6, -0.01, -5000.0, None]
+    data = pl.DataFrame({"MEDIAN_INCOME": median_income}, schema={"MEDIAN_INCOME": pl.Float64})
+    # bracket of a value is the one whose inclusive range holds it, as chained range conditions would code it
+    expected = pl.Series("MEDIAN_INCOME_BRACKET", [1, 1, 1, None, 2, 2, 4, 5, 8, None, 9, 9, None, None, None, None],
+                         dtype=pl.Int8)
+
+    data = ses.bracket_coding(data, "MEDIAN_INCOME", ses.median_income_ranges, "MEDIAN_INCOME_BRACKET")
+
+    assert_series_equal(data["MEDIAN_INCOME_BRACKET"], expected)
+
+
+def test_ordinal_coding_codes_known_answers_only():
+    ses = SocioEconomicStatus("cdr", client=object())
+    data = pl.DataFrame({"income_answer": ["Annual Income: less 10k", "Annual Income: 50k 75k",
+                                           "Annual Income: more 200k", "PMI: Skip", None]})
+
+    data = ses.ordinal_coding(data, "income_answer", ses.income_dict, "income_bracket")
+
+    assert_series_equal(data["income_bracket"], pl.Series("income_bracket", [1, 5, 9, None, None], dtype=pl.Int8))
+
+
+def test_ordinal_coding_rejects_gaps_in_codes():
+    with pytest.raises(ValueError):
+        SocioEconomicStatus.ordinal_coding(pl.DataFrame({"answer": ["a"]}), "answer", {"a": 1, "b": 3}, "code")
+
+
+def test_dummy_coding_codes_known_answers_only():
+    ses = SocioEconomicStatus("cdr", client=object())
+    data = pl.DataFrame({"home_answer": ["Current Home Own: Own", "Current Home Own: Rent",
+                                         "Current Home Own: Other Arrangement", None]})
+
+    data = ses.dummy_coding(data, "home_answer", ses.home_dict)
+
+    assert_series_equal(data["home_own"], pl.Series("home_own", [1, 0, 0, 0], dtype=pl.UInt8))
+    assert_series_equal(data["home_rent"], pl.Series("home_rent", [0, 1, 0, 0], dtype=pl.UInt8))
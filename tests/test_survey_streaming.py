@@ -0,0 +1,99 @@
+from benchmark import FakeBigQueryClient, synthetic_survey_data, synthetic_zip_code_ses
+from polars.testing import assert_frame_equal
+from survey import SocioEconomicStatus
+
+import os
+import pytest
+
+
+N_PARTICIPANTS = 2000
+
+
+@pytest.fixture
+def tables():
+    return {"ds_survey": synthetic_survey_data(N_PARTICIPANTS),
+            "ds_zip_code_socioeconomic": synthetic_zip_code_ses(N_PARTICIPANTS)}
+
+
+class FailingBatchClient:
+    """
+    fake BigQuery client whose streamed result fails after some batches
+    """
+
+    def __init__(self, table, batch_size, fail_after):
+        self.table = table
+        self.batch_size = batch_size
+        self.fail_after = fail_after
+        self.queries = []
+
+    def query(self, query):
+        self.queries.append(query)
+        return self
+
+    def result(self):
+        return self
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        for i, offset in enumerate(range(0, len(self.table), self.batch_size)):
+            if i == self.fail_after:
+                raise ConnectionError("stream reset")
+            yield from self.table.slice(offset, self.batch_size).to_arrow().to_batches()
+
+
+def cache_files(cache_dir):
+    return sorted(os.listdir(cache_dir))
+
+
+@pytest.mark.parametrize("smoking", [False, True])
+def test_streamed_equals_non_streamed(tables, smoking):
+    expected = SocioEconomicStatus("cdr", client=FakeBigQueryClient(tables)).parse_survey_data(smoking=smoking)
+    streamed = (SocioEconomicStatus("cdr", client=FakeBigQueryClient(tables, batch_size=777))
+                .parse_survey_data(smoking=smoking, streaming=True))
+
+    assert len(expected) > 0
+    assert_frame_equal(streamed, expected)
+
+
+def test_partially_consumed_stream_is_not_cached(tmp_path, tables):
+    client = FakeBigQueryClient(tables, batch_size=500)
+    ses = SocioEconomicStatus("cdr", cache_dir=str(tmp_path), client=client)
+
+    batches = ses.polar_gbq_batches("SELECT * FROM cdr.ds_survey", cache=ses.cache, cdr="cdr", client=client)
+    next(batches)
+    batches.close()
+
+    assert cache_files(tmp_path) == []
+
+
+def test_failed_stream_is_not_cached(tmp_path, tables):
+    client = FailingBatchClient(tables["ds_survey"], batch_size=500, fail_after=3)
+    ses = SocioEconomicStatus("cdr", cache_dir=str(tmp_path), client=client)
+
+    with pytest.raises(ConnectionError):
+        ses.stream_survey_answers("SELECT * FROM cdr.ds_survey")
+
+    assert cache_files(tmp_path) == []
+
+
+@pytest.mark.parametrize("first_streaming", [True, False])
+def test_streamed_and_non_streamed_calls_share_cache(tmp_path, tables, first_streaming):
+    client = FakeBigQueryClient(tables, batch_size=500)
+    first = (SocioEconomicStatus("cdr", cache_dir=str(tmp_path), client=client)
+             .parse_survey_data(streaming=first_streaming))
+    n_queries = len(client.queries)
+    second = (SocioEconomicStatus("cdr", cache_dir=str(tmp_path), client=client)
+              .parse_survey_data(streaming=not first_streaming))
+
+    # survey and SES results are both served from cache
+    assert len(client.queries) == n_queries
+    assert_frame_equal(second, first)
+
+
+def test_empty_result(tables):
+    tables["ds_survey"] = tables["ds_survey"].clear()
+
+    expected = SocioEconomicStatus("cdr", client=FakeBigQueryClient(tables)).parse_survey_data()
+    streamed = SocioEconomicStatus("cdr", client=FakeBigQueryClient(tables)).parse_survey_data(streaming=True)
+
+    assert len(streamed) == 0
+    assert_frame_equal(streamed, expected)